@@ -5,9 +5,11 @@ from torch.distributions import Normal
 from torch.autograd import Function
 import numpy as np
 from collections import Counter
+from model_v2 import GlobalDecoderMixin, encoder_hidden, index_global_decoder, one_hot_input, \
+                     teacher_forced_global_decoder
 
 
-class MusicAttrRegGMVAE(nn.Module):
+class MusicAttrRegGMVAE(GlobalDecoderMixin, nn.Module):
     """
     MusicAttrVAE with a GMM as latent prior distribution.
     Reference: https://github.com/yjlolo/vae-audio/blob/master/model/model.py
@@ -79,15 +81,15 @@ class MusicAttrRegGMVAE(nn.Module):
         x[arange, idx] = 1
         return x
 
-    def encode(self, x):
+    def encode(self, x, lengths=None):
+        x = one_hot_input(x, self.roll_dims)
+
         # rhythm encoder
-        x_r = self.gru_r(x)[-1]
-        x_r = x_r.transpose_(0, 1).contiguous().view(x_r.size(0), -1)
+        x_r = encoder_hidden(self.gru_r, x, lengths)
         mu_r, var_r = self.mu_r(x_r), self.var_r(x_r).exp_()
         
         # note encoder
-        x_n = self.gru_n(x)[-1]
-        x_n = x_n.transpose_(0, 1).contiguous().view(x_n.size(0), -1)
+        x_n = encoder_hidden(self.gru_n, x, lengths)
         mu_n, var_n = self.mu_n(x_n), self.var_n(x_n).exp_()
 
         dis_r = Normal(mu_r, var_r)
@@ -117,6 +119,10 @@ class MusicAttrRegGMVAE(nn.Module):
         return rhythm_out, note_out, 0, 0
     
     def global_decoder(self, z, steps):
+        if self.training and self.eps >= 1:     # p < eps always holds
+            return teacher_forced_global_decoder(self, z, steps)
+        if not self.training or not self.sample.is_floating_point():
+            return index_global_decoder(self, z, steps)
         out = torch.zeros((z.size(0), self.roll_dims)).cuda()
         out[:, -1] = 1.
         x, hx = [], [None, None]
@@ -217,14 +223,14 @@ class MusicAttrRegGMVAE(nn.Module):
         qy_x = torch.nn.functional.softmax(logLogit_qy_x, dim=1)
         return logLogit_qy_x, qy_x
 
-    def forward(self, x, rhythm, note, chroma):
+    def forward(self, x, rhythm, note, chroma, lengths=None):
         
         if self.training:
             self.sample = x
         
         # ========================== INFERENCE ====================== #
         # infer latent
-        dis_r, dis_n = self.encode(x)
+        dis_r, dis_n = self.encode(x, lengths)
         
         def repar(mu, stddev, sigma=1):
             eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
@@ -259,7 +265,7 @@ class MusicAttrRegGMVAE(nn.Module):
         return res
 
 
-class MusicAttrSingleGMVAE(nn.Module):
+class MusicAttrSingleGMVAE(GlobalDecoderMixin, nn.Module):
     """
     MusicAttrVAE with a GMM as latent prior distribution, without attribute modelling.
     Only one encoder is used to compare the usage of low-level features.
@@ -309,15 +315,18 @@ class MusicAttrSingleGMVAE(nn.Module):
         x[arange, idx] = 1
         return x
 
-    def encode(self, x):
+    def encode(self, x, lengths=None):
         # rhythm encoder
-        x = self.gru(x)[-1]
-        x = x.transpose_(0, 1).contiguous().view(x.size(0), -1)
+        x = encoder_hidden(self.gru, x, lengths)
         mu, var = self.mu(x), self.var(x).exp_()
 
         return Normal(mu, var)
 
     def global_decoder(self, z, steps):
+        if self.training and self.eps >= 1:     # p < eps always holds
+            return teacher_forced_global_decoder(self, z, steps)
+        if not self.training or not self.sample.is_floating_point():
+            return index_global_decoder(self, z, steps)
         out = torch.zeros((z.size(0), self.roll_dims)).cuda()
         out[:, -1] = 1.
         x, hx = [], [None, None]
@@ -407,14 +416,14 @@ class MusicAttrSingleGMVAE(nn.Module):
         return logLogit_qy_x, qy_x
 
     def forward(self, x, rhythm, note, chroma, c_r_oh, c_n_oh,
-                is_class=False, is_res=False):
+                is_class=False, is_res=False, lengths=None):
         
         if self.training:
             self.sample = x
         
         # ========================== INFERENCE ====================== #
         # infer latent
-        dis = self.encode(x)
+        dis = self.encode(x, lengths)
         
         def repar(mu, stddev, sigma=1):
             eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
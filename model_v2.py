@@ -1,12 +1,266 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pack_padded_sequence
 from torch.distributions import Normal
 from torch.autograd import Function
+import numpy as np
 from collections import Counter
 
 
-class MusicAttrRegVAE(nn.Module):
+def gru_cell_from_gates(gi, h, weight_hh, bias_hh):
+    '''
+    GRU cell update from precomputed input gates `gi`, with the same gate layout as nn.GRUCell.
+    '''
+    i_r, i_z, i_n = gi.chunk(3, -1)
+    h_r, h_z, h_n = F.linear(h, weight_hh, bias_hh).chunk(3, -1)
+    r = torch.sigmoid(i_r + h_r)
+    z = torch.sigmoid(i_z + h_z)
+    n = torch.tanh(i_n + r * h_n)
+    return n + z * (h - n)
+
+
+def one_hot_input(x, num_classes, const=None):
+    '''
+    Float one-hot of integer tokens, scattered straight into a float tensor, so no int64
+    one-hot is built, with a per-sequence `const` input filled into the last columns of
+    every step. Float input is taken to be one-hot already and returned as it is.
+    '''
+    if x.is_floating_point():
+        return x
+    width = num_classes + (0 if const is None else const.size(-1))
+    out = torch.zeros(x.shape + (width,), device=x.device)
+    out.scatter_(-1, x.long().unsqueeze(-1), 1.)
+    if const is not None:
+        out[..., num_classes:] = const.unsqueeze(1)
+    return out
+
+
+def encoder_hidden(gru, x, lengths=None, const=None):
+    '''
+    Final states of a bidirectional encoder GRU, flattened to (batch, 2 * hidden_dims).
+    With `lengths` the padded batch is packed, so both directions stop at the last real
+    step of every sequence and padding is never run through the GRU.
+    `x` is either a one-hot float tensor or integer tokens, which may come with a
+    per-sequence `const` input appended to every step. Tokens are expanded with
+    one_hot_input here, as the fused GRU kernels need a dense input; models with several
+    encoder GRUs expand them once and pass the one-hot to each.
+    '''
+    if not x.is_floating_point():
+        x = one_hot_input(x, gru.input_size - (0 if const is None else const.size(-1)), const)
+    if lengths is not None:
+        lengths = torch.as_tensor(lengths).cpu().long().clamp(min=1)
+        x = pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+    h = gru(x)[-1]
+    return h.transpose(0, 1).contiguous().view(h.size(1), -1)
+
+
+_SEQUENCE_GRUS = {}
+
+
+def gru_cell_sequence(cell, x, h):
+    '''
+    Run a GRUCell over a (batch, steps, input) sequence as one fused full-sequence GRU call:
+    a parameterless single-layer nn.GRU, built once per shape on the meta device, is called
+    with the parameters of the cell through torch.func.functional_call.
+    '''
+    key = (cell.input_size, cell.hidden_size, cell.bias)
+    if key not in _SEQUENCE_GRUS:
+        _SEQUENCE_GRUS[key] = nn.GRU(cell.input_size, cell.hidden_size, bias=cell.bias,
+                                     batch_first=True, device="meta")
+    params = {"weight_ih_l0": cell.weight_ih, "weight_hh_l0": cell.weight_hh}
+    if cell.bias:
+        params.update({"bias_ih_l0": cell.bias_ih, "bias_hh_l0": cell.bias_hh})
+    return torch.func.functional_call(_SEQUENCE_GRUS[key], params, (x, h.unsqueeze(0)))[0]
+
+
+def teacher_forced_global_decoder(model, z, steps):
+    '''
+    Fully teacher-forced global decoder. The targets in `sample`, shifted right behind the
+    start token, are the whole input sequence, so each layer runs as one GRU call with the
+    weights of grucell_g and grucell_g_2. The second layer starts from the first output of
+    the first layer, as in the step loop, and the logits are the same.
+    The GRU input, start token and targets one-hot followed by `z`, is filled into one
+    tensor; token ids are scattered into it without a separate one-hot.
+    '''
+    if model.sample.size(1) < steps - 1:
+        raise IndexError("{} decoding steps need at least {} target steps, got {}".format(
+                         steps, steps - 1, model.sample.size(1)))
+    sample = model.sample[:, :steps - 1]
+    x_in = z.new_zeros((z.size(0), steps, model.roll_dims + z.size(-1)))
+    x_in[:, 0, model.roll_dims - 1] = 1.
+    if sample.is_floating_point():
+        x_in[:, 1:, :model.roll_dims] = sample
+    else:
+        x_in[:, 1:, :model.roll_dims].scatter_(-1, sample.long().unsqueeze(-1), 1.)
+    x_in[:, :, model.roll_dims:] = z.unsqueeze(1)
+
+    h_1 = gru_cell_sequence(model.grucell_g, x_in, model.linear_init_global(z))
+    h_2 = gru_cell_sequence(model.grucell_g_2, h_1, h_1[:, 0])
+    return F.log_softmax(model.linear_out_g(h_2), -1)
+
+
+def start_decoder(model, z):
+    '''
+    Start token ids, initial hidden states and latent input projection of the global
+    decoder for step-wise decoding with decoder_step.
+    '''
+    cell = model.grucell_g
+    g_z = F.linear(z, cell.weight_ih[:, model.roll_dims:], cell.bias_ih)
+    token = torch.full((z.size(0),), model.roll_dims - 1, dtype=torch.long, device=z.device)
+    return token, [model.linear_init_global(z), None], g_z
+
+
+def decoder_step(model, token, hx, g_z):
+    '''
+    One global decoder step from the previous token ids. The one-hot part of the grucell_g
+    input projection is a column gather of its weights and `g_z` is the latent part from
+    start_decoder, so neither the concat nor the full-width matmul run per step.
+    Returns the raw logits and the new hidden states.
+    '''
+    cell = model.grucell_g
+    gi = F.embedding(token, cell.weight_ih[:, :model.roll_dims].t()) + g_z
+    h_1 = gru_cell_from_gates(gi, hx[0], cell.weight_hh, cell.bias_hh)
+    h_2 = model.grucell_g_2(h_1, h_1 if hx[1] is None else hx[1])
+    return model.linear_out_g(h_2), [h_1, h_2]
+
+
+def index_global_decoder(model, z, steps):
+    '''
+    Global decoder that feeds back the previous token as an id: the teacher-forced target
+    from `sample` in training, the argmax otherwise.
+    '''
+    token, hx, g_z = start_decoder(model, z)
+    x = []
+
+    for i in range(steps):
+        logits, hx = decoder_step(model, token, hx, g_z)
+        out = F.log_softmax(logits, 1)
+        x.append(out)
+        if model.training and torch.rand(1).item() < model.eps:
+            token = model.sample[:, i].long()
+        else:
+            token = out.max(1)[1]
+    return torch.stack(x, 1)
+
+
+def greedy_global_decoder(model, z, steps, return_scores=False):
+    '''
+    Greedy decoding that only keeps token ids: the argmax of the raw logits is fed back
+    through decoder_step, without log_softmax or one-hot tensors. Returns (batch, steps)
+    token ids and, with `return_scores`, the log-probability of every chosen token.
+    '''
+    token, hx, g_z = start_decoder(model, z)
+    tokens, scores = [], []
+
+    for i in range(steps):
+        logits, hx = decoder_step(model, token, hx, g_z)
+        token = logits.argmax(-1)
+        tokens.append(token)
+        if return_scores:
+            scores.append(logits.gather(1, token.unsqueeze(-1)).squeeze(-1) - torch.logsumexp(logits, -1))
+    
+    tokens = torch.stack(tokens, 1) if steps > 0 else z.new_zeros((z.size(0), 0), dtype=torch.long)
+    if return_scores:
+        return tokens, torch.stack(scores, 1) if steps > 0 else z.new_zeros((z.size(0), 0))
+    return tokens
+
+
+def generate_tokens(model, z, max_steps, stop_token=1):
+    '''
+    Greedy decoding of a batch of latents that stops every sequence at its first
+    `stop_token`. Finished rows are dropped from the decoder state, so later steps only
+    run the sequences still going, and decoding ends once all of them have stopped.
+    Returns a list of 1-D int arrays of token ids, one per latent, without the stop token.
+    '''
+    token, hx, g_z = start_decoder(model, z)
+    active = torch.arange(z.size(0), device=z.device)
+    rows, tokens = [], []
+
+    for i in range(max_steps):
+        logits, hx = decoder_step(model, token, hx, g_z)
+        token = logits.argmax(-1)
+        rows.append(active)
+        tokens.append(token)
+        keep = token != stop_token
+        if not keep.all():
+            active, token, g_z = active[keep], token[keep], g_z[keep]
+            hx = [h[keep] for h in hx]
+            if active.numel() == 0:
+                break
+
+    if not tokens:
+        return [np.zeros(0, dtype=np.int64) for _ in range(z.size(0))]
+    rows, tokens = torch.cat(rows).cpu().numpy(), torch.cat(tokens).cpu().numpy()
+    # steps were appended in order, so a stable sort by row keeps each sequence in order
+    order = np.argsort(rows, kind="stable")
+    rows, tokens = rows[order], tokens[order]
+    seqs = np.split(tokens, np.cumsum(np.bincount(rows, minlength=z.size(0)))[:-1])
+    return [s[:-1] if len(s) and s[-1] == stop_token else s for s in seqs]
+
+
+def stream_tokens(model, z, max_steps, stop_token=1, chunk_size=1, state=None, cancel=None):
+    '''
+    Greedy decoding as a generator, yielding (tokens, state) every `chunk_size` steps, where
+    `tokens` are the (batch, n) ids of the new steps and `state` the decoder state after them.
+    Passing a yielded `state` back in continues decoding from there. Decoding ends after
+    `max_steps`, once every row has emitted `stop_token`, or when the `cancel` event is set;
+    tokens a row emits after its stop token are not meaningful. Closing the generator also
+    cancels it.
+    '''
+    if state is None:
+        token, hx, g_z = start_decoder(model, z)
+        done = torch.zeros_like(token, dtype=torch.bool)
+    else:
+        token, hx, g_z, done = state
+    if done.all():
+        return
+    tokens = []
+
+    for i in range(max_steps):
+        if cancel is not None and cancel.is_set():
+            return
+        logits, hx = decoder_step(model, token, hx, g_z)
+        token = logits.argmax(-1)
+        tokens.append(token)
+        done = done | (token == stop_token)
+        last = i == max_steps - 1 or done.all()
+        if len(tokens) == chunk_size or last:
+            yield torch.stack(tokens, 1), (token, hx, g_z, done)
+            tokens = []
+        if last:
+            return
+
+
+class GlobalDecoderMixin:
+    '''
+    Inference helpers shared by the models with a grucell_g / grucell_g_2 global decoder.
+    '''
+    def generate(self, z, max_steps, stop_token=1):
+        '''
+        Greedy decoding of a batch of latents, stopping each sequence at `stop_token`.
+        Returns ragged token arrays, see generate_tokens.
+        '''
+        with torch.no_grad():
+            return generate_tokens(self, z, max_steps, stop_token)
+
+    @torch.no_grad()
+    def stream(self, z, max_steps, stop_token=1, chunk_size=1, state=None, cancel=None):
+        '''
+        Greedy decoding that yields token chunks as they are produced, see stream_tokens.
+        '''
+        yield from stream_tokens(self, z, max_steps, stop_token, chunk_size, state, cancel)
+
+    @torch.no_grad()
+    def greedy_decode(self, z, steps, return_scores=False):
+        '''
+        Fixed-length greedy decoding to (batch, steps) token ids, optionally with their
+        log-probabilities, see greedy_global_decoder.
+        '''
+        return greedy_global_decoder(self, z, steps, return_scores)
+
+
+class MusicAttrRegVAE(GlobalDecoderMixin, nn.Module):
     '''
     Music FaderNets, vanilla VAE model.
     Regularization loss can be GLSR or Pati et al. in trainer section.
@@ -78,15 +332,15 @@ class MusicAttrRegVAE(nn.Module):
         x[arange, idx] = 1
         return x
 
-    def encoder(self, x):
+    def encoder(self, x, lengths=None):
+        x = one_hot_input(x, self.roll_dims)
+
         # rhythm encoder
-        x_r = self.gru_r(x)[-1]
-        x_r = x_r.transpose_(0, 1).contiguous().view(x_r.size(0), -1)
+        x_r = encoder_hidden(self.gru_r, x, lengths)
         mu_r, var_r = self.mu_r(x_r), self.var_r(x_r).exp_()
         
         # note encoder
-        x_n = self.gru_n(x)[-1]
-        x_n = x_n.transpose_(0, 1).contiguous().view(x_n.size(0), -1)
+        x_n = encoder_hidden(self.gru_n, x, lengths)
         mu_n, var_n = self.mu_n(x_n), self.var_n(x_n).exp_()
 
         dis_r = Normal(mu_r, var_r)
@@ -116,6 +370,10 @@ class MusicAttrRegVAE(nn.Module):
         return rhythm_out, note_out
     
     def global_decoder(self, z, steps):
+        if self.training and self.eps >= 1:     # p < eps always holds
+            return teacher_forced_global_decoder(self, z, steps)
+        if not self.training or not self.sample.is_floating_point():
+            return index_global_decoder(self, z, steps)
         out = torch.zeros((z.size(0), self.roll_dims)).cuda()
         out[:, -1] = 1.
         x, hx = [], [None, None]
@@ -142,12 +400,12 @@ class MusicAttrRegVAE(nn.Module):
                 out = self._sampling(out)
         return torch.stack(x, 1)
 
-    def forward(self, x, rhythm, note, chroma):
+    def forward(self, x, rhythm, note, chroma, lengths=None):
         if self.training:
             self.sample = x
             self.iteration += 1
         
-        dis_r, dis_n = self.encoder(x)
+        dis_r, dis_n = self.encoder(x, lengths)
         
         def repar(mu, stddev, sigma=1):
             eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
@@ -171,7 +429,7 @@ class MusicAttrRegVAE(nn.Module):
         return res
 
 
-class MusicAttrSingleVAE(nn.Module):
+class MusicAttrSingleVAE(GlobalDecoderMixin, nn.Module):
     '''
     Single encoder VAE with reg. loss by Pati et al. (2019).
     '''
@@ -224,15 +482,18 @@ class MusicAttrSingleVAE(nn.Module):
         x[arange, idx] = 1
         return x
 
-    def encoder(self, x):
+    def encoder(self, x, lengths=None):
         # encoder
-        x = self.gru(x)[-1]
-        x = x.transpose_(0, 1).contiguous().view(x.size(0), -1)
+        x = encoder_hidden(self.gru, x, lengths)
         mu, var = self.mu(x), self.var(x).exp_()
 
         return Normal(mu, var)
 
     def global_decoder(self, z, steps):
+        if self.training and self.eps >= 1:     # p < eps always holds
+            return teacher_forced_global_decoder(self, z, steps)
+        if not self.training or not self.sample.is_floating_point():
+            return index_global_decoder(self, z, steps)
         out = torch.zeros((z.size(0), self.roll_dims)).cuda()
         out[:, -1] = 1.
         x, hx = [], [None, None]
@@ -261,14 +522,14 @@ class MusicAttrSingleVAE(nn.Module):
                 out = self._sampling(out)
         return torch.stack(x, 1)
 
-    def forward(self, x, chroma):
+    def forward(self, x, chroma, lengths=None):
         
         if self.training:
             self.sample = x
             self.iteration += 1
         
         # residual or without
-        dis = self.encoder(x)
+        dis = self.encoder(x, lengths)
         
         def repar(mu, stddev, sigma=1):
             eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
@@ -285,7 +546,7 @@ class MusicAttrSingleVAE(nn.Module):
         return res
 
 
-class MusicAttrCVAE(nn.Module):
+class MusicAttrCVAE(GlobalDecoderMixin, nn.Module):
     '''
     CVAE model - one encoder, decode with concatenated conditions.
     '''
@@ -339,14 +600,15 @@ class MusicAttrCVAE(nn.Module):
         x[arange, idx] = 1
         return x
 
-    def encoder(self, x, r_density, n_density, chroma):
-        r_density_rpt = torch.stack([r_density] * x.shape[1], dim=1)
-        n_density_rpt = torch.stack([n_density] * x.shape[1], dim=1)
-        x_in = torch.cat([x, r_density_rpt, n_density_rpt], dim=-1)
-
+    def encoder(self, x, r_density, n_density, chroma, lengths=None):
         # 1 encoder
-        h = self.gru_e(x_in)[-1]
-        h = h.transpose_(0, 1).contiguous().view(h.size(0), -1)
+        if not x.is_floating_point():
+            h = encoder_hidden(self.gru_e, x, lengths, const=torch.cat([r_density, n_density], dim=-1))
+        else:
+            r_density_rpt = torch.stack([r_density] * x.shape[1], dim=1)
+            n_density_rpt = torch.stack([n_density] * x.shape[1], dim=1)
+            x_in = torch.cat([x, r_density_rpt, n_density_rpt], dim=-1)
+            h = encoder_hidden(self.gru_e, x_in, lengths)
         mu, var = self.mu(h), self.var(h).exp_()
 
         dis = Normal(mu, var)
@@ -373,6 +635,10 @@ class MusicAttrCVAE(nn.Module):
         return rhythm_out, note_out, 0, 0
     
     def global_decoder(self, z, steps):
+        if self.training and self.eps >= 1:     # p < eps always holds
+            return teacher_forced_global_decoder(self, z, steps)
+        if not self.training or not self.sample.is_floating_point():
+            return index_global_decoder(self, z, steps)
         out = torch.zeros((z.size(0), self.roll_dims)).cuda()
         out[:, -1] = 1.
         x, hx = [], [None, None]
@@ -399,14 +665,14 @@ class MusicAttrCVAE(nn.Module):
                 out = self._sampling(out)
         return torch.stack(x, 1)
 
-    def forward(self, x, rhythm, note, chroma, r_density, n_density):
+    def forward(self, x, rhythm, note, chroma, r_density, n_density, lengths=None):
         
         if self.training:
             self.sample = x
             self.iteration += 1
         
         # residual or without
-        dis = self.encoder(x, r_density, n_density, chroma)
+        dis = self.encoder(x, r_density, n_density, chroma, lengths)
         
         def repar(mu, stddev, sigma=1):
             eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
@@ -435,7 +701,7 @@ class ReverseLayerF(Function):
         return output, None
 
     
-class MusicAttrFaderNets(nn.Module):
+class MusicAttrFaderNets(GlobalDecoderMixin, nn.Module):
     '''
     Fader Networks model - basically a CVAE with adversarial loss training.
     '''
@@ -494,9 +760,8 @@ class MusicAttrFaderNets(nn.Module):
         x[arange, idx] = 1
         return x
 
-    def encoder(self, x):
-        h = self.gru_e(x)[-1]
-        h = h.transpose_(0, 1).contiguous().view(h.size(0), -1)
+    def encoder(self, x, lengths=None):
+        h = encoder_hidden(self.gru_e, x, lengths)
         mu, var = self.mu(h), self.var(h).exp_()
 
         dis = Normal(mu, var)
@@ -525,6 +790,10 @@ class MusicAttrFaderNets(nn.Module):
         return rhythm_out, note_out, 0, 0
     
     def global_decoder(self, z, steps):
+        if self.training and self.eps >= 1:     # p < eps always holds
+            return teacher_forced_global_decoder(self, z, steps)
+        if not self.training or not self.sample.is_floating_point():
+            return index_global_decoder(self, z, steps)
         out = torch.zeros((z.size(0), self.roll_dims)).cuda()
         out[:, -1] = 1.
         x, hx = [], [None, None]
@@ -556,14 +825,14 @@ class MusicAttrFaderNets(nn.Module):
                 out = self._sampling(out)
         return torch.stack(x, 1)
 
-    def forward(self, x, rhythm, note, chroma, r_density, n_density):
+    def forward(self, x, rhythm, note, chroma, r_density, n_density, lengths=None):
         
         if self.training:
             self.sample = x
             self.iteration += 1
         
         # residual or without
-        dis = self.encoder(x)
+        dis = self.encoder(x, lengths)
         
         def repar(mu, stddev, sigma=1):
             eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
@@ -1,6 +1,8 @@
 import pypianoroll
 import numpy as np
 import os
+import time
+import pretty_midi
 from tqdm import tqdm
 
 # 0-127 note on, 128 start token, 129 end token, 130 shift, 131-258 note off
@@ -11,20 +13,10 @@ VELOCITY_DISPLACEMENT = 260
 
 
 def convert_pr_to_pitch_lst(pr):
-    output_idx = []
-    velocity_idx = []
-    
-    for i in range(len(pr)):
-        indices = np.argwhere(pr[i] > 0)
-        if len(indices) > 0:
-            if len(indices) == 1:
-                indices = np.expand_dims(indices.squeeze(), axis=0)
-            else:
-                indices = indices.squeeze()
-        indices = list(indices)
-        velocity = [pr[i][j] for j in indices]
-        output_idx.append(indices)
-        velocity_idx.append(velocity)
+    rows, cols = np.nonzero(pr > 0)
+    bounds = np.cumsum(np.bincount(rows, minlength=len(pr)))[:-1]
+    output_idx = [list(k) for k in np.split(cols, bounds)]
+    velocity_idx = [list(k) for k in np.split(pr[rows, cols], bounds)]
     
     return output_idx, velocity_idx
 
@@ -137,6 +129,87 @@ def pitch_lst_to_pr(pitch_lst, velocity_lst):
     return pr
 
 
+def batch_events_to_pr(tokens, lengths=None):
+    '''
+    Vectorized decode_events over a padded (N, L) token array. Tokens at or past
+    `lengths` are ignored. Returns (N, T, 128) velocity pianorolls, T being the largest
+    number of shift tokens in the batch, and the number of decoded steps per sequence.
+    '''
+    tokens = np.asarray(tokens).astype(int)
+    if tokens.ndim == 1:
+        tokens = tokens[np.newaxis]
+    n, l = tokens.shape
+    if lengths is None:
+        lengths = np.full(n, l)
+
+    valid = np.arange(l) < np.asarray(lengths)[:, np.newaxis]
+    is_shift = valid & (tokens == shift())
+    steps = is_shift.sum(axis=1)
+    num_steps = steps.max() if n > 0 else 0
+    # a token affects every step read off by a later shift token
+    step_of = np.cumsum(is_shift, axis=1) - is_shift
+
+    # note-on / note-off events sorted by (sequence, pitch, position)
+    is_onset = valid & (tokens < 128)
+    is_offset = valid & (tokens >= OFFSET_DISPLACEMENT) & (tokens < OFFSET_DISPLACEMENT + 128)
+    seq, t = np.nonzero(is_onset | is_offset)
+    pitch = np.where(is_onset[seq, t], tokens[seq, t], tokens[seq, t] - OFFSET_DISPLACEMENT)
+    group = seq * 128 + pitch
+    order = np.argsort(group * l + t, kind="stable")
+    seq, t, pitch, group = seq[order], t[order], pitch[order], group[order]
+    first = np.ones(len(group), bool)
+    first[1:] = group[1:] != group[:-1]
+
+    # sounding count per group. events_to_pitch_lst ignores a note-off for a pitch that is
+    # not sounding, so the count is the running sum reflected at 0: S - min(0, min(S))
+    step = np.where(is_onset[seq, t], 1, -1)
+    walk = np.cumsum(step)
+    group_start = np.maximum.accumulate(np.where(first, np.arange(len(first)), 0))
+    walk -= (walk - step)[group_start]
+    # offsetting each group below the previous one keeps the running minimum per group
+    offset = np.cumsum(first) * (l + 1)
+    count = walk - (np.minimum.accumulate(np.minimum(walk, 0) - offset) + offset)
+
+    # a velocity token applies to the latest onset, if that pitch is still sounding
+    last_onset = np.maximum.accumulate(np.where(is_onset, np.arange(l), -1), axis=1)
+    prev_onset = np.where(last_onset >= 0, np.take_along_axis(tokens, np.maximum(last_onset, 0), axis=1), 0)
+    v_seq, v_t = np.nonzero(valid & (tokens > VELOCITY_DISPLACEMENT))
+    v_pitch = prev_onset[v_seq, v_t]
+    idx = np.searchsorted(group * l + t, (v_seq * 128 + v_pitch) * l + v_t) - 1
+    # without any note-on / note-off in the batch no velocity token can apply
+    applied = (idx >= 0) & (group[np.maximum(idx, 0)] == v_seq * 128 + v_pitch) if len(group) > 0 \
+              else np.zeros(len(v_seq), bool)
+    applied[applied] = count[idx[applied]] > 0
+    v_group = v_seq * 128 + v_pitch
+    order = np.argsort(v_group[applied] * l + v_t[applied], kind="stable")
+    v_seq, v_t, v_pitch = v_seq[applied][order], v_t[applied][order], v_pitch[applied][order]
+    v_group = v_group[applied][order]
+    v_first = np.ones(len(v_group), bool)
+    v_first[1:] = v_group[1:] != v_group[:-1]
+    velocity = tokens[v_seq, v_t] - VELOCITY_DISPLACEMENT
+
+    # both are step functions per group, so paint their changes onto the step grid
+    def paint(seq, t, pitch, value, first, initial):
+        change = value - np.where(first, initial, np.roll(value, 1))
+        flat = (seq * (num_steps + 1) + step_of[seq, t]) * 128 + pitch
+        grid = np.bincount(flat, weights=change, minlength=n * (num_steps + 1) * 128)
+        return initial + np.cumsum(grid.reshape(n, num_steps + 1, 128)[:, :num_steps], axis=1)
+
+    sounding = paint(seq, t, pitch, count, first, 0) > 0
+    sounding[:, :, 0] = False
+    pr = np.where(sounding, paint(v_seq, v_t, v_pitch, velocity, v_first, 100), 0.)
+    pr[np.arange(num_steps) >= steps[:, np.newaxis]] = 0
+    return pr, steps
+
+
+def batch_decode_events(tokens, lengths=None):
+    '''
+    Batched counterpart of decode_events returning a list of (T_i, 128) pianorolls.
+    '''
+    pr, steps = batch_events_to_pr(tokens, lengths=lengths)
+    return [pr[i, :steps[i]] for i in range(len(pr))]
+
+
 def pitch_lst_to_rhythm(output_idx):    
     rhythm_lst = []
     if len(output_idx[0]) > 0:
@@ -158,6 +231,103 @@ def pitch_lst_to_rhythm(output_idx):
     return ret
 
 
+def pr_to_rhythm(pr):
+    '''
+    Vectorized pitch_lst_to_rhythm. Accepts a (T, 128) pianoroll or a (N, T, 128) stack:
+    0 for rest, 1 when any new pitch starts, 2 when only held pitches sound.
+    '''
+    active = np.asarray(pr) > 0
+    new_pitch = active.copy()
+    new_pitch[..., 1:, :] &= ~active[..., :-1, :]
+    rhythm = np.where(new_pitch.any(axis=-1), 1, 2)
+    rhythm[~active.any(axis=-1)] = 0
+    return rhythm
+
+
+def batch_pr_to_events(prs):
+    '''
+    Vectorized pr_to_events over a list (or stack) of pianoroll segments. Onsets, offsets
+    and velocity changes come from diffs of consecutive timesteps; the tokens of every
+    step are then laid out with one sort. Returns one token array per segment.
+    '''
+    if len(prs) == 0:
+        return []
+    
+    # one extra all-zero step per segment carries its final note-offs
+    lengths = np.array([len(pr) for pr in prs])
+    ends = np.cumsum(lengths + 1) - 1
+    starts = ends - lengths
+    is_end = np.zeros(ends[-1] + 1, bool)
+    is_end[ends] = True
+    cur = np.zeros((len(is_end), 128), np.int16)
+    cur[~is_end] = np.concatenate(prs).reshape(-1, 128)
+    prev = np.zeros_like(cur)
+    prev[1:] = cur[:-1]
+    prev[starts] = 0
+
+    on_prev, on_cur, same = prev > 0, cur > 0, prev == cur
+    re_onsets = on_prev & on_cur & ~same    # held notes played again with a new velocity
+    new_onsets = on_cur & ~on_prev
+
+    # pr_to_events re-adds a pitch to holding_pitches twice when it is played again with a
+    # new velocity, and keeps both copies until its next note-off. Mark those steps, as the
+    # count decides how many note-on / note-off tokens are emitted.
+    held = on_cur.astype(np.int8)
+    row_re, pitch_re = np.nonzero(re_onsets)
+    if len(row_re) > 0:
+        on_next = np.zeros_like(on_cur)
+        on_next[:-1] = on_cur[1:]
+        pitch_last, row_last = np.nonzero((on_cur & ~on_next).T)
+        last = row_last[np.searchsorted(pitch_last * len(cur) + row_last, pitch_re * len(cur) + row_re)]
+        run = last - row_re + 1
+        rows = np.arange(run.sum()) - np.repeat(np.cumsum(run) - run, run) + np.repeat(row_re, run)
+        held[rows, np.repeat(pitch_re, run)] = 2
+    held_prev = np.zeros_like(held)
+    held_prev[1:] = held[:-1]
+    held_prev[starts] = 0
+
+    n_offs = np.where(on_prev & ~on_cur, held_prev, 0)
+    n_ons = new_onsets + np.where(re_onsets, np.where(held_prev == 1, 2, 1), 0)
+
+    # at the end of a segment pr_to_events removes from holding_pitches while iterating
+    # over it, so only every other entry of the sorted list gets its note-off
+    end_held = n_offs[is_end]
+    end_pos = np.cumsum(end_held, axis=1) - end_held
+    n_offs[is_end] = (end_held == 2) + ((end_held == 1) & (end_pos % 2 == 0))
+
+    # sort key: step, then offs < re-onset offs < (note-on, velocity) pairs < shift
+    row_off, pitch_off = np.nonzero(n_offs)
+    reps = n_offs[row_off, pitch_off]
+    row_off, pitch_off = np.repeat(row_off, reps), np.repeat(pitch_off, reps)
+    row_on, pitch_on = np.nonzero(n_ons)
+    reps = n_ons[row_on, pitch_on]
+    row_on, pitch_on = np.repeat(row_on, reps), np.repeat(pitch_on, reps)
+    rep_on = np.arange(len(row_on)) - np.repeat(np.cumsum(reps) - reps, reps)
+    row_shift = np.nonzero(~is_end)[0]
+    keys = np.concatenate([row_off * 2048 + pitch_off * 4,
+                           row_re * 2048 + 512 + pitch_re * 4,
+                           row_on * 2048 + 1024 + pitch_on * 4 + rep_on * 2,
+                           row_on * 2048 + 1024 + pitch_on * 4 + rep_on * 2 + 1,
+                           row_shift * 2048 + 1536])
+    tokens = np.concatenate([pitch_off + OFFSET_DISPLACEMENT,
+                             pitch_re + OFFSET_DISPLACEMENT,
+                             pitch_on,
+                             cur[row_on, pitch_on] + VELOCITY_DISPLACEMENT,
+                             np.full(len(row_shift), shift())])
+    order = np.argsort(keys, kind="stable")
+    tokens, rows = tokens[order], keys[order] // 2048
+    
+    counts = np.bincount(np.searchsorted(ends, rows), minlength=len(prs))
+    return np.split(tokens, np.cumsum(counts)[:-1])
+
+
+def fast_pr_to_events(pr):
+    '''
+    Vectorized pr_to_events for a single (T, 128) pianoroll.
+    '''
+    return batch_pr_to_events([pr])[0]
+
+
 def encode_midi(fname, beat=24, is_pr=False):
     if not is_pr:
         track = pypianoroll.parse(fname, beat_resolution=beat)
@@ -165,8 +335,8 @@ def encode_midi(fname, beat=24, is_pr=False):
     else:
         pr = fname
     pitch_lst, velocity_lst = convert_pr_to_pitch_lst(pr)
-    rhythm = pitch_lst_to_rhythm(pitch_lst)
-    events = pr_to_events(pitch_lst, velocity_lst)
+    rhythm = pr_to_rhythm(pr).tolist()
+    events = fast_pr_to_events(pr).tolist()
     return events, pitch_lst, velocity_lst, pr, rhythm
 
 
@@ -201,7 +371,9 @@ def parse_pretty_midi(
         collect_onsets_only=False,
         threshold=0,
         first_beat_time=None,
-        beat_resolution=4
+        beat_resolution=4,
+        vectorized=True,
+        return_tracks=False
     ):
     """
     Parse a :class:`pretty_midi.PrettyMIDI` object. The data type of the
@@ -248,6 +420,16 @@ def parse_pretty_midi(
     first_beat_time : float
         The location (in sec) of the first beat. Required and only effective
         when using 'custom' algorithm.
+    beat_resolution : int
+        The number of time steps per beat. Defaults to 4.
+    vectorized : bool
+        True to fill the pianorolls with :func:`rasterize_notes`. False to
+        use the original per-note loop. Both give identical arrays.
+    return_tracks : bool
+        True to return the pianorolls of all instruments as a list, without
+        the empty ones if `skip_empty_tracks` is True, like the tracks of
+        :func:`pypianoroll.parse`. False to return the pianoroll of the last
+        instrument only. Defaults to False.
 
     Notes
     -----
@@ -340,6 +522,7 @@ def parse_pretty_midi(
             pianoroll = np.zeros((n_time_steps, 128), np.uint8)
         else:
             pianoroll = np.zeros((n_time_steps, 128), int)
+        tracks.append(pianoroll)
 
         pitches = np.array(
             [note.pitch for note in instrument.notes if note.end > first_beat_time]
@@ -382,6 +565,13 @@ def parse_pretty_midi(
             )
             note_offs = ((beat_indices + ratios) * beat_resolution).astype(int)
 
+            if vectorized:
+                velocities = np.array([note.velocity for note in instrument.notes], int)
+                rasterize_notes(pianoroll, note_ons, note_offs, pitches, 
+                                velocities[:len(pitches)], mode=mode, 
+                                binarized=binarized, threshold=threshold)
+                continue
+
             for idx, start in enumerate(note_ons):
                 end = note_offs[idx]
                 velocity = instrument.notes[idx].velocity
@@ -411,10 +601,131 @@ def parse_pretty_midi(
                     )
                     pianoroll[start:end, pitches[idx]] = maximum
 
+    if return_tracks:
+        return [k for k in tracks if not skip_empty_tracks or k.any()]
+    return pianoroll
+
+
+def rasterize_notes(pianoroll, note_ons, note_offs, pitches, velocities,
+                    mode="max", binarized=False, threshold=0):
+    '''
+    Vectorized note loop of parse_pretty_midi, filling `pianoroll` in place. Notes of the
+    same pitch interact through the boundary fixes when the cells they touch overlap, so
+    notes are grouped into chains of overlapping notes and painted in waves: wave k holds
+    the k-th note of every chain, which never share a cell.
+    '''
+    n_time_steps = len(pianoroll)
+    keep = velocities >= 1
+    if binarized:
+        keep &= velocities > threshold
+    starts, ends = np.asarray(note_ons)[keep], np.asarray(note_offs)[keep]
+    pitches, velocities = np.asarray(pitches)[keep], velocities[keep]
+    if len(pitches) == 0:
+        return pianoroll
+
+    # cells a note may read or write: start - 1 up to end, or the whole column for notes
+    # whose slice may wrap around (an end of 0 can be cut back to -1)
+    touch_lo = np.clip(np.minimum(starts - 1, ends), 0, n_time_steps - 1)
+    touch_hi = np.clip(np.maximum(starts, ends), 0, n_time_steps - 1)
+    wraps = (starts < 0) | (ends <= 0)
+    touch_lo[wraps], touch_hi[wraps] = 0, n_time_steps - 1
+
+    # chains of notes of the same pitch with overlapping cells
+    order = np.lexsort((touch_lo, pitches))
+    reach = np.maximum.accumulate(pitches[order] * n_time_steps + touch_hi[order])
+    first = np.ones(len(order), bool)
+    first[1:] = (pitches[order][1:] != pitches[order][:-1]) | \
+                (pitches[order][1:] * n_time_steps + touch_lo[order][1:] > reach[:-1])
+    chain = np.empty(len(order), int)
+    chain[order] = np.cumsum(first)
+    
+    # rank of each note within its chain, in loop order
+    order = np.argsort(chain, kind="stable")
+    first = np.ones(len(order), bool)
+    first[1:] = chain[order][1:] != chain[order][:-1]
+    chain_start = np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))
+    rank = np.empty(len(order), int)
+    rank[order] = np.arange(len(order)) - chain_start
+
+    for wave in np.split(np.argsort(rank, kind="stable"), np.cumsum(np.bincount(rank))[:-1]):
+        start, end, pitch = starts[wave], ends[wave].copy(), pitches[wave]
+
+        # a note directly after a sounding one cuts it one step short
+        cut = (start > 0) & (start < n_time_steps)
+        cut[cut] = pianoroll[start[cut] - 1, pitch[cut]] != 0
+        pianoroll[start[cut] - 1, pitch[cut]] = 0
+
+        # and ends one step early when it runs into a sounding one
+        check = end < n_time_steps - 1
+        check[check] = pianoroll[end[check], pitch[check]] != 0
+        end[check] -= 1
+
+        # pianoroll[start:end] with python slice semantics
+        lo = np.clip(np.where(start < 0, start + n_time_steps, start), 0, n_time_steps)
+        hi = np.clip(np.where(end < 0, end + n_time_steps, end), 0, n_time_steps)
+        length = np.maximum(hi - lo, 0)
+        rows = np.repeat(lo - np.cumsum(length) + length, length) + np.arange(length.sum())
+        cols = np.repeat(pitch, length)
+
+        if binarized:
+            if mode == "sum":
+                pianoroll[rows, cols] += 1
+            elif mode == "max":
+                pianoroll[rows, cols] = True
+        elif mode == "sum":
+            pianoroll[rows, cols] += np.repeat(velocities[wave], length)
+        elif mode == "max":
+            pianoroll[rows, cols] = np.maximum(pianoroll[rows, cols], 
+                                               np.repeat(velocities[wave], length))
+
     return pianoroll
 
 
+def benchmark_parse_pretty_midi(num_of_files=5, num_of_notes=20000, seed=0):
+    '''
+    Time parse_pretty_midi with the vectorized rasterizer against the per-note loop on
+    synthetic piano performances, checking that both give identical pianorolls.
+    '''
+    random_state = np.random.RandomState(seed)
+    pms = []
+    for _ in range(num_of_files):
+        pm = pretty_midi.PrettyMIDI(initial_tempo=120.)
+        pm.time_signature_changes.append(pretty_midi.TimeSignature(4, 4, 0.))
+        instrument = pretty_midi.Instrument(program=0)
+        starts = np.sort(random_state.uniform(0, num_of_notes / 20, num_of_notes))
+        lengths = random_state.exponential(0.4, num_of_notes)
+        pitches = np.clip(random_state.normal(64, 12, num_of_notes), 21, 108).astype(int)
+        velocities = random_state.randint(1, 128, num_of_notes)
+        for start, length, pitch, velocity in zip(starts, lengths, pitches, velocities):
+            instrument.notes.append(pretty_midi.Note(velocity=int(velocity), pitch=int(pitch),
+                                                     start=float(start), end=float(start + length)))
+        pm.instruments.append(instrument)
+        pms.append(pm)
+
+    for mode, binarized in [("max", False), ("max", True), ("sum", False)]:
+        loop_time, vectorized_time = 0, 0
+        for pm in pms:
+            t = time.time()
+            pr_loop = parse_pretty_midi(pm, mode=mode, binarized=binarized, vectorized=False)
+            loop_time += time.time() - t
+            t = time.time()
+            pr = parse_pretty_midi(pm, mode=mode, binarized=binarized, vectorized=True)
+            vectorized_time += time.time() - t
+            assert pr.dtype == pr_loop.dtype and (pr == pr_loop).all()
+
+        print("mode={} binarized={}: loop {:.3f}s, vectorized {:.3f}s ({:.1f}x)".format(
+            mode, binarized, loop_time, vectorized_time, loop_time / vectorized_time))
+
+
 def main():
+    # vectorized decoder matches the loop decoder on batches without notes
+    for events in [[130, 300, 130], [130, 130, 130], [300, 310], [300, 130, 261, 130], [], [129, 259, 130]]:
+        pr, _, _ = decode_events(events)
+        batch_pr, steps = batch_events_to_pr([events])
+        assert (batch_pr[0, :steps[0]] == pr.reshape(-1, 128)).all()
+    batch_pr, steps = batch_events_to_pr([[130, 300, 130, 0], [300, 130, 130, 130]], lengths=[3, 4])
+    assert (steps == [2, 3]).all() and not batch_pr.any()
+
     # labelled_midi = ["../../labelled/pieces/midi/" + k for k in os.listdir("../../labelled/pieces/midi/")]
     labelled_midi = ["/data/classic-piano/" + k for k in os.listdir("/data/classic-piano/")]
     for i in tqdm(range(len(labelled_midi))):
@@ -423,6 +734,14 @@ def main():
         pr, pitch_lst_2, velocity_lst_2 = decode_events(events)
         assert ((pr_ori == pr).all()) == True
 
+        # vectorized encoder matches the loop encoder
+        assert events == pr_to_events(pitch_lst, velocity_lst)
+        assert rhythm == pitch_lst_to_rhythm(pitch_lst)
+
+        # vectorized decoder matches the loop decoder
+        batch_pr, steps = batch_events_to_pr([events])
+        assert (batch_pr[0, :steps[0]] == pr.reshape(-1, 128)).all()
+
 
 if __name__ == "__main__":
     main()
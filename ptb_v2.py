@@ -1,18 +1,24 @@
 import os
 import io
 import json
+import hashlib
+import shutil
+import contextlib
 import torch
 import numpy as np
 from collections import defaultdict
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
 # from tslearn.clustering import TimeSeriesKMeans
 from tqdm import tqdm
 import pretty_midi
 from collections import Counter
 import sys, math
+import queue
+import threading
 import pypianoroll
 from polyphonic_event_based_v2 import *
-from multiprocessing.dummy import Pool as ThreadPool
+from multiprocessing import Pool
 from sklearn.preprocessing import StandardScaler
 import music21
 
@@ -33,68 +39,323 @@ MIN_TEMPO = 57
 MAX_TEMPO = 258
 MIN_VELOCITY = 0
 MAX_VELOCITY = 126
+FEATURE_CACHE_DIR = "data/values_v3/cache"
+DATA_STORE_DIR = "data/values_v3/store"
+MUSIC_ATTRIBUTES = ("events", "rhythm", "note_density", "chroma", "velocity")
+KEY_ESTIMATOR = "builtin"
+FEATURE_CACHE_VERSION = 2       # bump whenever process_data or its helpers change
+STORE_DTYPES = {"tokens": np.int16, "rhythm": np.uint8, "note_density": np.uint8, "chroma": np.float32}
+SEGMENT_PARAMS = {"short": (4, 4, 100), "long": (4, 16, 250)}   # beat_res, num_of_beats, max_tokens
 
+# key profiles used by music21's default key analysis (Aarden-Essen), starting on the tonic
+MAJOR_KEY_PROFILE = np.array([17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587, 
+                              0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122])
+MINOR_KEY_PROFILE = np.array([18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362, 
+                              0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623])
 
-def magenta_encode_midi(midi_filename, is_eos=False):
-    mpe = MidiPerformanceEncoder(
-            steps_per_second=STEPS_PER_SECOND,
-            num_velocity_bins=NUM_VELOCITY_BINS,
-            min_pitch=MIN_PITCH,
-            max_pitch=MAX_PITCH,
-            add_eos=is_eos)
-    ns = magenta.music.midi_file_to_sequence_proto(midi_filename)
+
+_PERFORMANCE_ENCODERS = {}
+
+
+def get_performance_encoder(is_eos=False):
+    '''
+    Return a MidiPerformanceEncoder for this process, built once and then reused.
+    '''
+    if is_eos not in _PERFORMANCE_ENCODERS:
+        _PERFORMANCE_ENCODERS[is_eos] = MidiPerformanceEncoder(
+                                            steps_per_second=STEPS_PER_SECOND,
+                                            num_velocity_bins=NUM_VELOCITY_BINS,
+                                            min_pitch=MIN_PITCH,
+                                            max_pitch=MAX_PITCH,
+                                            add_eos=is_eos)
+    return _PERFORMANCE_ENCODERS[is_eos]
+
+
+def magenta_encode_midi(midi, is_eos=False):
+    '''
+    Encode a MIDI file, or a pretty_midi object held in memory, into performance tokens.
+    '''
+    mpe = get_performance_encoder(is_eos)
+    if isinstance(midi, pretty_midi.PrettyMIDI):
+        ns = magenta.music.midi_to_note_sequence(midi)
+    else:
+        ns = magenta.music.midi_file_to_sequence_proto(midi)
     return mpe.encode_note_sequence(ns)
 
 
 def magenta_decode_midi(notes, is_eos=False):
-    mpe = MidiPerformanceEncoder(
-            steps_per_second=STEPS_PER_SECOND,
-            num_velocity_bins=NUM_VELOCITY_BINS,
-            min_pitch=MIN_PITCH,
-            max_pitch=MAX_PITCH,
-            add_eos=is_eos)
+    mpe = get_performance_encoder(is_eos)
     pm = mpe.decode(notes, return_pm=True)
     return pm
 
 
-def slice_midi(pm, beats, start_idx, end_idx):
+class PerformanceNoteDecoder:
     '''
-    Slice given pretty_midi object into number of beat segments.
+    Incremental decoder of MidiPerformanceEncoder tokens into pretty_midi notes. The current
+    step, velocity and sounding notes are kept between calls to decode(), so every token is
+    read once. A note is returned when its note-off arrives and finish() ends the notes still
+    sounding at the current step, with the same notes as MidiPerformanceEncoder.decode.
     '''
-    new_pm = pretty_midi.PrettyMIDI()
-    new_inst = pretty_midi.Instrument(program=pm.instruments[0].program,
-                                      is_drum=pm.instruments[0].is_drum,
-                                      name=pm.instruments[0].name)
-    start, end = beats[start_idx], beats[end_idx]
-    for i in range(len(pm.instruments)):
-        for note in pm.instruments[i].notes:
-            velocity, pitch = note.velocity, note.pitch
-            if note.start > end or note.start < start:
+    def __init__(self, num_reserved_ids=2):
+        num_of_pitches = MAX_PITCH - MIN_PITCH + 1
+        # token ranges of the note-on, note-off, time shift and velocity events
+        self.note_on = num_reserved_ids
+        self.note_off = self.note_on + num_of_pitches
+        self.time_shift = self.note_off + num_of_pitches
+        self.velocity_bin = self.time_shift + STEPS_PER_SECOND
+        self.vocab_size = self.velocity_bin + NUM_VELOCITY_BINS
+        self.seconds_per_step = 1.0 / STEPS_PER_SECOND
+
+        self.step, self.velocity = 0, 100
+        self.sounding = defaultdict(list)    # pitch -> [(start step, velocity)]
+
+    def _note(self, pitch, start_step, velocity):
+        return pretty_midi.Note(velocity=velocity, pitch=pitch, start=start_step * self.seconds_per_step,
+                                end=self.step * self.seconds_per_step)
+
+    def decode(self, tokens):
+        '''
+        Read `tokens` and return the notes they end. Reserved ids such as padding are skipped.
+        '''
+        notes = []
+        for token in tokens:
+            token = int(token)
+            if token < self.note_on:
                 continue
+            elif token < self.note_off:
+                self.sounding[MIN_PITCH + token - self.note_on].append((self.step, self.velocity))
+            elif token < self.time_shift:
+                pitch = MIN_PITCH + token - self.note_off
+                if self.sounding[pitch]:
+                    start_step, velocity = self.sounding[pitch].pop(0)
+                    if start_step != self.step:     # zero duration notes are dropped
+                        notes.append(self._note(pitch, start_step, velocity))
+            elif token < self.velocity_bin:
+                self.step += token - self.time_shift + 1
+            elif token < self.vocab_size:
+                self.velocity = 1 + (token - self.velocity_bin) * int(math.ceil(127 / NUM_VELOCITY_BINS))
             else:
-                s = note.start - start
-                if note.end > end:
-                    e = end - start
-                else:
-                    e = note.end - start
-            new_note = pretty_midi.Note(
-                velocity=velocity, pitch=pitch, start=s, end=e)
-            new_inst.notes.append(new_note)
+                raise ValueError("Token {} is not a performance event.".format(token))
+        return notes
+
+    def finish(self):
+        '''
+        End the notes still sounding at the current step and return them.
+        '''
+        notes = [self._note(pitch, start_step, velocity) for pitch, starts in self.sounding.items() \
+                 for start_step, velocity in starts if start_step != self.step]
+        self.sounding.clear()
+        return notes
+
+
+def stream_decode_notes(token_chunks, stop_token=1, row=None):
+    '''
+    Decode a stream of performance token chunks into notes as they are completed. Chunks are
+    1-D token arrays, (batch, n) arrays of which `row` is decoded, or the (tokens, state)
+    pairs yielded by model.stream, so its generator can be passed in directly. `row` may only
+    be left out for a batch of one.
+    Only the new tokens of every chunk are decoded, with a PerformanceNoteDecoder that keeps
+    its state between chunks, and the notes they end are yielded as a list sorted by start
+    time; the notes still sounding are yielded once the stream stops, at `stop_token` or
+    when it runs out.
+    '''
+    decoder = PerformanceNoteDecoder()
+    notes = []
+
+    for chunk in token_chunks:
+        if isinstance(chunk, tuple):
+            chunk = chunk[0]
+        if isinstance(chunk, torch.Tensor):
+            chunk = chunk.cpu()
+        chunk = np.asarray(chunk)
+        if chunk.ndim == 2:
+            if row is None and len(chunk) != 1:
+                raise ValueError("Chunks hold {} sequences, pass the `row` to decode.".format(len(chunk)))
+            chunk = chunk[0 if row is None else row]
+        chunk = [int(t) for t in chunk]
+        is_stop = stop_token in chunk
+        notes += decoder.decode(chunk[:chunk.index(stop_token)] if is_stop else chunk)
+        if is_stop:
+            break
+        if notes:
+            yield sorted(notes, key=lambda n: n.start)
+            notes = []
+
+    notes += decoder.finish()
+    if notes:
+        yield sorted(notes, key=lambda n: n.start)
+
+
+def get_note_index(pm):
+    '''
+    Start-time sorted arrays of the notes and control changes of all instruments.
+    `order` keeps the position in the original instrument-by-instrument listing.
+    '''
+    notes = [note for instrument in pm.instruments for note in instrument.notes]
+    ctrls = [ctrl for instrument in pm.instruments for ctrl in instrument.control_changes]
+
+    note_start = np.array([note.start for note in notes], dtype=float)
+    note_order = np.argsort(note_start, kind="stable")
+    ctrl_time = np.array([ctrl.time for ctrl in ctrls], dtype=float)
+    ctrl_order = np.argsort(ctrl_time, kind="stable")
+
+    note_index = {
+        "start": note_start[note_order],
+        "end": np.array([note.end for note in notes], dtype=float)[note_order],
+        "pitch": np.array([note.pitch for note in notes], dtype=int)[note_order],
+        "velocity": np.array([note.velocity for note in notes], dtype=int)[note_order],
+        "order": note_order,
+    }
+    ctrl_index = {
+        "time": ctrl_time[ctrl_order],
+        "number": np.array([ctrl.number for ctrl in ctrls], dtype=int)[ctrl_order],
+        "value": np.array([ctrl.value for ctrl in ctrls], dtype=int)[ctrl_order],
+        "order": ctrl_order,
+    }
+    return note_index, ctrl_index
+
+
+def slice_midi_segments(pm, beats, windows, index=None):
+    '''
+    Slice given pretty_midi object into all (start_idx, end_idx) beat windows in one pass.
+    Each window is a binary search into the sorted note index from get_note_index. Notes
+    starting within [start, end] are kept and cut at the window end, control changes
+    within [start, end) are kept, the same as slice_midi.
+    '''
+    note_index, ctrl_index = get_note_index(pm) if index is None else index
+    windows = np.asarray(windows, dtype=int).reshape(-1, 2)
+    starts, ends = beats[windows[:, 0]], beats[windows[:, 1]]
+
+    note_lo = np.searchsorted(note_index["start"], starts, side="left")
+    note_hi = np.searchsorted(note_index["start"], ends, side="right")
+    ctrl_lo = np.searchsorted(ctrl_index["time"], starts, side="left")
+    ctrl_hi = np.searchsorted(ctrl_index["time"], ends, side="left")
+
+    new_pms = []
+    for k in range(len(windows)):
+        start, end = starts[k], ends[k]
+        new_pm = pretty_midi.PrettyMIDI()
+        new_inst = pretty_midi.Instrument(program=pm.instruments[0].program,
+                                          is_drum=pm.instruments[0].is_drum,
+                                          name=pm.instruments[0].name)
+        
+        # restore the instrument-by-instrument order of slice_midi
+        idx = note_lo[k] + np.argsort(note_index["order"][note_lo[k]:note_hi[k]])
+        note_start = (note_index["start"][idx] - start).tolist()
+        note_end = (np.where(note_index["end"][idx] > end, end, note_index["end"][idx]) - start).tolist()
+        new_inst.notes = [pretty_midi.Note(velocity=velocity, pitch=pitch, start=s, end=e) \
+                          for velocity, pitch, s, e in zip(note_index["velocity"][idx].tolist(),
+                                                           note_index["pitch"][idx].tolist(),
+                                                           note_start, note_end)]
+
+        idx = ctrl_lo[k] + np.argsort(ctrl_index["order"][ctrl_lo[k]:ctrl_hi[k]])
+        new_inst.control_changes = [pretty_midi.ControlChange(number=number, value=value, time=time) \
+                                    for number, value, time in zip(ctrl_index["number"][idx].tolist(),
+                                                                   ctrl_index["value"][idx].tolist(),
+                                                                   (ctrl_index["time"][idx] - start).tolist())]
+
+        new_pm.instruments.append(new_inst)
+        new_pms.append(new_pm)
+
+    return new_pms
+
+
+def slice_midi(pm, beats, start_idx, end_idx):
+    '''
+    Slice given pretty_midi object into number of beat segments.
+    '''
+    return slice_midi_segments(pm, beats, [(start_idx, end_idx)])[0]
+
+
+def get_key_profiles():
+    '''
+    (12, 24) matrix of the key profiles rotated to every tonic, centred and normalised so
+    that a product with a centred histogram gives Pearson correlations. Major keys first.
+    '''
+    profiles = []
+    for profile in [MAJOR_KEY_PROFILE, MINOR_KEY_PROFILE]:
+        for tonic in range(12):
+            profiles.append(np.roll(profile, tonic))
+    profiles = np.array(profiles).T
+    profiles = profiles - profiles.mean(axis=0)
+    return profiles / np.sqrt(np.sum(profiles ** 2, axis=0))
+
+
+def get_batch_pitch_class_histogram(prs):
+    '''
+    Pitch class histograms of a (N, T, 128) stack of piano rolls, weighting each pitch by
+    the number of time steps it sounds. Token sequences can be converted first with
+    batch_events_to_pr.
+    '''
+    durations = np.count_nonzero(np.asarray(prs) > 0, axis=-2)
+    padded = np.zeros(durations.shape[:-1] + (132,))
+    padded[..., :128] = durations
+    return padded.reshape(durations.shape[:-1] + (11, 12)).sum(axis=-2)
 
-        for ctrl in pm.instruments[i].control_changes:
-            if ctrl.time >= start and ctrl.time < end:
-                new_ctrl = pretty_midi.ControlChange(
-                    number=ctrl.number, value=ctrl.value, time=ctrl.time - start)
-                new_inst.control_changes.append(new_ctrl)
 
-    new_pm.instruments.append(new_inst)
-    new_pm.write('tmp.mid')
-    return new_pm
+def get_pitch_class_histogram(pm):
+    '''
+    Pitch class histogram of a pretty_midi object, weighting each note by its length in
+    quarter notes like music21 does.
+    '''
+    histogram = np.zeros(12)
+    for instrument in pm.instruments:
+        if instrument.is_drum:
+            continue
+        for note in instrument.notes:
+            length = pm.time_to_tick(note.end) - pm.time_to_tick(note.start)
+            histogram[note.pitch % 12] += length / pm.resolution
+    return histogram
+
+
+def get_segment_pitch_class_histograms(pm, beats, windows, index=None):
+    '''
+    Pitch class histograms of all (start_idx, end_idx) beat windows of a pretty_midi object
+    at once, with the notes slice_midi_segments keeps for each window. They match
+    get_pitch_class_histogram of the sliced segments, up to tick rounding and scale.
+    '''
+    note_index, _ = get_note_index(pm) if index is None else index
+    windows = np.asarray(windows, dtype=int).reshape(-1, 2)
+    starts, ends = beats[windows[:, 0]], beats[windows[:, 1]]
+    histograms = np.zeros((len(windows), 12))
+    if len(pm.instruments) == 0 or pm.instruments[0].is_drum:     # sliced segments take this flag
+        return histograms
+
+    note_lo = np.searchsorted(note_index["start"], starts, side="left")
+    note_hi = np.searchsorted(note_index["start"], ends, side="right")
+    counts = note_hi - note_lo
+    seg = np.repeat(np.arange(len(windows)), counts)
+    note = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - note_lo, counts)
+    length = np.minimum(note_index["end"][note], ends[seg]) - note_index["start"][note]
+    np.add.at(histograms, (seg, note_index["pitch"][note] % 12), length)
+    return histograms
+
+
+def batch_harmony_vector(histograms, is_one_hot=False):
+    '''
+    Score all 24 keys for a (N, 12) batch of pitch class histograms with one matrix
+    multiply. Returns (N, 24) correlations in the format of get_harmony_vector, or one-hot
+    vectors of the best key. Rows of empty histograms stay all zero.
+    '''
+    histograms = np.asarray(histograms, dtype=float)
+    centred = histograms - histograms.mean(axis=-1, keepdims=True)
+    norm = np.sqrt(np.sum(centred ** 2, axis=-1, keepdims=True))
+    corr = np.matmul(centred, get_key_profiles()) / np.where(norm > 0, norm, 1)
+    
+    res = np.zeros_like(corr)
+    if is_one_hot:
+        res[np.arange(len(res)), np.argmax(corr, axis=-1)] = 1
+    else:
+        res = np.where(corr < 0.1, 0, corr)    # zero out negative values
+    res[norm[:, 0] == 0] = 0
+    return res
 
 
-def get_harmony_vector(fname, is_one_hot=False):
+def get_harmony_vector(fname, is_one_hot=False, estimator=KEY_ESTIMATOR):
     '''
-    Obtain estimated key for a given music segment with music21 library.
+    Obtain estimated key for a given music segment, either with the built-in estimator
+    or with music21 library (`estimator` = "music21").
+    `fname` is a MIDI file path or a pretty_midi object, which is parsed from memory.
     '''
     CHORD_DICT = {
     "C-": 11, "C": 0, "C#": 1, "D-": 1, "D": 2, "D#": 3, "E-": 3, "E": 4, "E#": 5,
@@ -103,7 +364,19 @@ def get_harmony_vector(fname, is_one_hot=False):
     }
 
     try:
-        score = music21.converter.parse(fname)
+        if estimator == "builtin":
+            pm = fname if isinstance(fname, pretty_midi.PrettyMIDI) else pretty_midi.PrettyMIDI(fname)
+            histogram = get_pitch_class_histogram(pm)
+            if not histogram.any():
+                raise ValueError("no notes to estimate the key from")
+            return batch_harmony_vector(histogram[np.newaxis], is_one_hot=is_one_hot)[0]
+
+        if isinstance(fname, pretty_midi.PrettyMIDI):
+            midi_bytes = io.BytesIO()
+            fname.write(midi_bytes)
+            score = music21.converter.parseData(midi_bytes.getvalue(), format="midi")
+        else:
+            score = music21.converter.parse(fname)
         key = score.analyze('key')
         res = np.zeros(24,)
         name, mode = key.tonic.name, key.mode
@@ -129,31 +402,76 @@ def get_harmony_vector(fname, is_one_hot=False):
         return None
 
 
-def get_music_attributes(pr, beat=24):
+def harmony_parity_report(midis, num_of_samples=100, seed=0):
     '''
-    Get musical attributes including rhythm density, note_density, chroma and velocity
-    for a given piano roll segment.
+    Compare the built-in key estimator against music21 on a random sample of segments,
+    given as MIDI paths or pretty_midi objects. Reports how often the best key agrees and
+    the mean absolute difference of the correlation vectors.
     '''
-    events, pitch_lst, velocity_lst, pr, rhythm = encode_midi(pr, beat=beat, is_pr=True)
+    random_state = np.random.RandomState(seed)
+    idx = random_state.permutation(len(midis))[:num_of_samples]
+
+    same_key, same_mode, diff = [], [], []
+    for i in tqdm(idx):
+        ref = get_harmony_vector(midis[i], estimator="music21")
+        res = get_harmony_vector(midis[i], estimator="builtin")
+        if ref is None or res is None:
+            continue
+        same_key.append(np.argmax(ref) == np.argmax(res))
+        same_mode.append((np.argmax(ref) < 12) == (np.argmax(res) < 12))
+        diff.append(np.mean(np.abs(ref - res)))
+    
+    report = {"num_of_samples": len(diff),
+              "key_agreement": np.mean(same_key) if diff else float("nan"),
+              "mode_agreement": np.mean(same_mode) if diff else float("nan"),
+              "mean_abs_diff": np.mean(diff) if diff else float("nan")}
+    print("Key estimator parity on {} segments: key agreement {:.3f}, mode agreement {:.3f}, " \
+          "mean abs difference {:.4f}".format(report["num_of_samples"], report["key_agreement"],
+                                            report["mode_agreement"], report["mean_abs_diff"]))
+    return report
 
-    # get note density
-    note_density = np.array([len(k) for k in pitch_lst])
 
-    # get chroma
-    chroma = np.zeros((pr.shape[0], 12))
-    for note in range(12):
-        chroma[:, note] = np.sum(pr[:, note::12], axis=1)
+def get_batch_music_attributes(prs, attributes=("rhythm", "note_density")):
+    '''
+    Get musical attributes for a (N, T, 128) stack of piano roll segments at once.
+    Only the requested attributes out of MUSIC_ATTRIBUTES are computed. Returns a dict
+    of (N, T) arrays, (N, T, 12) for chroma and a list of token arrays for events.
+    '''
+    unknown = set(attributes) - set(MUSIC_ATTRIBUTES)
+    if unknown:
+        raise ValueError("Unknown music attributes: {}".format(sorted(unknown)))
     
-    # get velocity
-    velocity = []
-    for i in range(len(pr)):
-        if len(np.nonzero(pr[i])[0]) > 0:
-            velocity.append(int(np.sum(pr[i]) / len(np.nonzero(pr[i])[0])))
-        else:
-            velocity.append(0)
-    velocity = np.array(velocity)
+    prs = np.asarray(prs)
+    res = {}
+    if "events" in attributes:
+        res["events"] = batch_pr_to_events(prs)
+    if "rhythm" in attributes:
+        res["rhythm"] = pr_to_rhythm(prs)
+    if "note_density" in attributes or "velocity" in attributes:
+        note_density = np.count_nonzero(prs > 0, axis=-1)
+        if "note_density" in attributes:
+            res["note_density"] = note_density
+    if "chroma" in attributes:
+        # fold the 128 pitches onto 11 octaves of 12 pitch classes
+        padded = np.zeros(prs.shape[:-1] + (132,))
+        padded[..., :128] = prs
+        res["chroma"] = padded.reshape(prs.shape[:-1] + (11, 12)).sum(axis=-2)
+    if "velocity" in attributes:
+        total = prs.sum(axis=-1)
+        res["velocity"] = np.where(note_density > 0, 
+                                    (total / np.maximum(note_density, 1)).astype(int), 0)
+    
+    return res
 
-    return events, rhythm, note_density, chroma, velocity
+
+def get_music_attributes(pr, beat=24):
+    '''
+    Get musical attributes including rhythm density, note_density, chroma and velocity
+    for a given piano roll segment.
+    '''
+    res = get_batch_music_attributes(np.asarray(pr)[np.newaxis], MUSIC_ATTRIBUTES)
+    return res["events"][0].tolist(), res["rhythm"][0].tolist(), res["note_density"][0], \
+            res["chroma"][0], res["velocity"][0]
 
 
 def get_average_av_values(av_dict, key):
@@ -217,178 +535,659 @@ def get_average_av_values(av_dict, key):
 def process_data(name, beat_res=4, num_of_beats=4, max_tokens=100):
     '''
     Utility function for each data function to extract required data.
+    The file is parsed once; the piano roll, beat grid, segments, tokens and keys
+    all come from that pretty_midi object. With the built-in key estimator the keys of
+    all kept segments are scored in one batch.
+    Segments are kept in memory as pretty_midi objects, so concurrent calls are safe.
     '''
     data_lst = []
     rhythm_lst = []
     note_density_lst = []
     chroma_lst = []
     
-    track = pypianoroll.parse(name, beat_resolution=beat_res).tracks
+    pm = pretty_midi.PrettyMIDI(name)
+    tracks = []
+    if len(pm.instruments) > 0:
+        beats = pm.get_beats()
+        tracks = parse_pretty_midi(pm, beat_resolution=beat_res, return_tracks=True)
+
+    if len(tracks) > 0:
+        pr = tracks[0]      # first non-empty track, as in pypianoroll.parse(name).tracks[0]
+
+        # rhythm and note density of all segments at once, padding the last one with rests
+        seg_len = beat_res * num_of_beats
+        num_of_segments = -(-len(pr) // seg_len)
+        segments = np.zeros((num_of_segments * seg_len, 128), dtype=pr.dtype)
+        segments[:len(pr)] = pr
+        attributes = get_batch_music_attributes(segments.reshape(num_of_segments, seg_len, 128),
+                                                ("rhythm", "note_density"))
+
+        # slice every segment that fits in the beat grid in one pass
+        seg_starts = [j for j in range(0, len(pr), seg_len) if (j + seg_len) // beat_res < len(beats)]
+        index = get_note_index(pm)
+        new_pms = slice_midi_segments(pm, beats, [(j // beat_res, (j + seg_len) // beat_res) \
+                                                  for j in seg_starts], index=index)
 
-    if len(track) > 0:
+        # extract segment by segment
+        kept = []
+        for j, new_pm in zip(seg_starts, new_pms):
+            start_idx = j
+            end_idx = j + seg_len
+            new_pr = pr[start_idx : end_idx]
+            ms = np.argmax(new_pr, axis=-1)
+
+            # ensure each segment is not empty and contain unique notes
+            if len(new_pm.instruments[0].notes) > 0 and \
+                len(np.unique(ms)) > 2 and np.count_nonzero(ms) >= 0.75 * len(ms):
+
+                # get musical attributes
+                rhythm = attributes["rhythm"][j // seg_len][:len(new_pr)].tolist()
+                note_density = attributes["note_density"][j // seg_len][:len(new_pr)]
+
+                # get midi encoding sequence
+                events = magenta_encode_midi(new_pm)
+                events.append(1)    # EOS token
+
+                # filter out segments that start with 0 and limit token length
+                if rhythm[0] == 1 and len(events) <= max_tokens:   
+                    kept.append((j, new_pm, events, rhythm, note_density))
+
+        # keys of all kept segments, scored together
+        if KEY_ESTIMATOR == "builtin" and len(kept) > 0:
+            histograms = get_segment_pitch_class_histograms(pm, beats, [(k[0] // beat_res, (k[0] + seg_len) // beat_res) \
+                                                                        for k in kept], index=index)
+            chromas = [c if h.any() else None for c, h in zip(batch_harmony_vector(histograms), histograms)]
+        else:
+            chromas = [get_harmony_vector(k[1]) for k in kept]
+
+        for (j, new_pm, events, rhythm, note_density), chroma in zip(kept, chromas):
+            if chroma is None:      # key estimation failed
+                continue
+            
+            # aggregate data points
+            data_lst.append(torch.Tensor(events))
+            rhythm_lst.append(rhythm)
+            note_density_lst.append(note_density)
+            chroma_lst.append(chroma)
+
+    return data_lst, rhythm_lst, note_density_lst, chroma_lst
+
+
+def track_parity_report(names, beat_res=4):
+    '''
+    Compare the piano roll process_data segments, the first non-empty track parsed from
+    the in-memory pretty_midi object, against the first track of pypianoroll.parse on the
+    given MIDI paths. Reports the files where the number of tracks or the roll differ.
+    '''
+    def parse_tracks(name, reference):
         try:
+            if reference:
+                return [track.pianoroll for track in pypianoroll.parse(name, beat_resolution=beat_res).tracks]
             pm = pretty_midi.PrettyMIDI(name)
-            beats = pm.get_beats()
-            tempo = pm.get_tempo_changes()
-            cur_idx, tempo_new = 0, []
+            return parse_pretty_midi(pm, beat_resolution=beat_res, return_tracks=True) \
+                   if len(pm.instruments) > 0 else []
+        except ValueError:      # no beat grid to quantize with, so no segments either way
+            return []
+
+    mismatches = []
+    for name in tqdm(names):
+        ref, res = parse_tracks(name, True), parse_tracks(name, False)
+        if len(ref) != len(res) or (len(ref) > 0 and not np.array_equal(ref[0], res[0])):
+            mismatches.append(name)
+
+    print("Track parity on {} files: {} mismatches".format(len(names), len(mismatches)))
+    return mismatches
+
+
+def get_feature_cache_key(name, beat_res=4, num_of_beats=4, max_tokens=100):
+    '''
+    Content hash of a MIDI file together with the segmentation parameters, key estimator
+    and FEATURE_CACHE_VERSION, so entries of an older feature extraction are not reused.
+    '''
+    h = hashlib.sha1()
+    with open(name, "rb") as f:
+        h.update(f.read())
+    h.update("{}_{}_{}_{}_v{}".format(beat_res, num_of_beats, max_tokens, KEY_ESTIMATOR, 
+                                      FEATURE_CACHE_VERSION).encode())
+    return h.hexdigest()
+
+
+def pack_segments(data_lst, rhythm_lst, note_density_lst, chroma_lst, seg_len):
+    '''
+    Pack the segments of one file, as returned by process_data, into flat int16 tokens with
+    their lengths and one array per other column. This is the format of feature cache
+    entries and of the process pool results, which cross the pool as a few plain arrays.
+    '''
+    lengths = np.array([len(k) for k in data_lst], dtype=np.int64)
+    if len(data_lst) > 0:
+        tokens = np.concatenate([np.asarray(k) for k in data_lst]).astype(np.int16)
+    else:
+        tokens = np.zeros((0,), dtype=np.int16)
+    return {"tokens": tokens,
+            "lengths": lengths,
+            "rhythm": np.array(rhythm_lst).reshape(-1, seg_len),
+            "note_density": np.array(note_density_lst).reshape(-1, seg_len),
+            "chroma": np.array(chroma_lst).reshape(-1, 24)}
+
+
+def unpack_segments(segments):
+    '''
+    Per-segment lists of packed segments. Token rows are views of the flat token array.
+    '''
+    lengths = segments["lengths"]
+    data_lst = np.split(segments["tokens"], np.cumsum(lengths)[:-1]) if len(lengths) > 0 else []
+    return data_lst, list(segments["rhythm"]), list(segments["note_density"]), list(segments["chroma"])
+
+
+def save_feature_cache(fname, segments):
+    '''
+    Save the packed segments of one file as a cache entry.
+    The entry is written to a temporary file first so readers never see a partial file.
+    '''
+    tmp_fname = "{}.{}.tmp".format(fname, os.getpid())
+    with open(tmp_fname, "wb") as f:
+        np.savez(f, **segments)
+    os.replace(tmp_fname, fname)
+
+
+def load_feature_cache(fname):
+    '''
+    Load a cache entry as packed segments, see pack_segments.
+    '''
+    with np.load(fname) as entry:
+        return {k: entry[k] for k in ["tokens", "lengths", "rhythm", "note_density", "chroma"]}
+
+
+def _process_file(job):
+    '''
+    Process pool worker for get_classic_piano. Each worker handles whole files, reading
+    from the feature cache when an entry for the file content and parameters exists.
+    Segments are returned packed, see pack_segments.
+    '''
+    name, beat_res, num_of_beats, max_tokens, cache_dir = job
+    try:
+        key = get_feature_cache_key(name, beat_res, num_of_beats, max_tokens)
+        cache_fname = os.path.join(cache_dir, key + ".npz")
+        if os.path.exists(cache_fname):
+            return key, load_feature_cache(cache_fname)
+
+        res = process_data(name,
+                           beat_res=beat_res,
+                           num_of_beats=num_of_beats,
+                           max_tokens=max_tokens)
+        segments = pack_segments(*res, seg_len=beat_res * num_of_beats)
+        save_feature_cache(cache_fname, segments)
+        return key, segments
+
+    except Exception as e:
+        print(e)
+        return None
+
+
+class RaggedArray:
+    '''
+    Sequences of varying length stored as one flat array with (N + 1) offsets.
+    An int index gives one sequence as a view, a slice gives a RaggedArray view and
+    an index array or mask gives a RaggedArray copy. `width` is the padded length
+    used by to_padded, which defaults to the longest sequence.
+    '''
+    def __init__(self, values, offsets, width=None):
+        self.values = values
+        self.offsets = offsets
+        self.width = width if width is not None else \
+                     (int(self.lengths.max()) if len(self) > 0 else 0)
+
+    @classmethod
+    def from_sequences(cls, seqs, dtype=np.int16):
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(k) for k in seqs])
+        values = np.concatenate([np.asarray(k) for k in seqs]) if len(seqs) > 0 \
+                 else np.zeros((0,), dtype=dtype)
+        return cls(values if dtype is None else values.astype(dtype), offsets)
+
+    @classmethod
+    def from_padded(cls, padded, pad_value=0, dtype=np.int16):
+        '''
+        Strip the trailing padding from the rows of a dense (N, L) array.
+        '''
+        padded = np.asarray(padded)
+        is_value = padded != pad_value
+        lengths = np.where(is_value.any(axis=1), 
+                           padded.shape[1] - np.argmax(is_value[:, ::-1], axis=1), 0)
+        offsets = np.zeros(len(padded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        values = padded[np.arange(padded.shape[1]) < lengths[:, np.newaxis]].astype(dtype)
+        return cls(values, offsets, width=padded.shape[1])
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+    
+    @property
+    def shape(self):
+        return (len(self), self.width)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_padded(dtype=dtype)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < -len(self) or idx >= len(self):
+                raise IndexError("index {} is out of bounds for {} sequences".format(idx, len(self)))
+            idx = idx % len(self)
+            return self.values[self.offsets[idx] : self.offsets[idx + 1]]
         
-        except Exception as e:
-            print(e)
+        if isinstance(idx, slice) and idx.step in (None, 1):
+            start, stop, _ = idx.indices(len(self))
+            return RaggedArray(self.values, self.offsets[start : max(start, stop) + 1], width=self.width)
+
+        idx = np.arange(len(self))[idx]
+        lengths = self.lengths[idx]
+        offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        positions = np.repeat(self.offsets[idx] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedArray(self.values[positions], offsets, width=self.width)
+
+    def to_padded(self, width=None, pad_value=0, dtype=None):
+        '''
+        Dense (N, width) array of the sequences, cut or padded with `pad_value`.
+        '''
+        width = self.width if width is None else width
+        res = np.full((len(self), width), pad_value, dtype=self.values.dtype if dtype is None else dtype)
+        is_value = np.arange(width) < self.lengths[:, np.newaxis]
+        res[is_value] = self.values[(self.offsets[:-1, np.newaxis] + np.arange(width))[is_value]]
+        return res
 
-        pr = track[0].pianoroll
 
-        # extract segment by segment
-        for j in range(0, len(pr), beat_res * num_of_beats):
-            start_idx = j
-            end_idx = j + beat_res * num_of_beats
-
-            if end_idx // beat_res < len(beats):
-                new_pr = pr[start_idx : end_idx]
-                new_pm = slice_midi(pm, beats, start_idx // beat_res, end_idx // beat_res)
-                new_pm.write("tmp.mid")
-                ms = np.argmax(new_pr, axis=-1)
-
-                # ensure each segment is not empty and contain unique notes
-                if len(new_pm.instruments[0].notes) > 0 and \
-                    len(np.unique(ms)) > 2 and np.count_nonzero(ms) >= 0.75 * len(ms):
-
-                    # get musical attributes
-                    _, rhythm, note_density, chroma, \
-                        velocity = get_music_attributes(new_pr, beat=beat_res)
-
-                    # get midi encoding sequence
-                    events = magenta_encode_midi("tmp.mid")
-                    events.append(1)    # EOS token
-
-                    # filter out segments that start with 0 and limit token length
-                    if rhythm[0] == 1 and len(events) <= max_tokens:   
-                        chroma = get_harmony_vector()    # read from saved "tmp.mid" file
-                        
-                        # aggregate data points
-                        data_lst.append(torch.Tensor(events))
-                        rhythm_lst.append(rhythm)
-                        note_density_lst.append(note_density)
-                        chroma_lst.append(chroma)
+class RowView:
+    '''
+    Read-only view of the rows `idx` of an array or RaggedArray. Subsets and splits of
+    a memory-mapped store stay index views, so every process reading the store shares
+    the same page cache instead of holding its own copy.
+    '''
+    def __init__(self, base, idx):
+        self.base = base
+        self.idx = np.asarray(idx, dtype=np.int64)
+
+    @property
+    def shape(self):
+        return (len(self.idx),) + tuple(self.base.shape[1:])
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.base[self.idx[idx]]
+        return RowView(self.base, self.idx[idx])
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.base[self.idx], dtype=dtype)
+
+
+class SegmentStoreWriter:
+    '''
+    Stream segments into a store directory without holding them in memory.
+    Ragged columns are written flat with int64 offsets, the others as fixed width rows,
+    all in the dtypes of `dtypes`. close() optionally shuffles the segments with
+    `seed` and writes one .npy file per column.
+    '''
+    def __init__(self, path, dtypes=STORE_DTYPES, ragged=("tokens",)):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtypes = dtypes
+        self.ragged = ragged
+        self.files = {k: open(os.path.join(path, k + ".bin.tmp"), "wb") for k in dtypes}
+        self.lengths = {k: [] for k in ragged}
+        self.row_shapes = {}
+        self.num_of_segments = 0
+
+    def add(self, **columns):
+        '''
+        Append segments, given as one list of rows per column.
+        '''
+        if set(columns) != set(self.dtypes):
+            raise ValueError("Expected columns {}".format(sorted(self.dtypes)))
+        num_of_segments = len(columns[next(iter(self.dtypes))])
+        if num_of_segments == 0:
+            return
+
+        for k, rows in columns.items():
+            if len(rows) != num_of_segments:
+                raise ValueError("Column `{}` has {} rows, expected {}".format(k, len(rows), num_of_segments))
+            rows = [np.asarray(row) for row in rows]
+            if k in self.ragged:
+                self.lengths[k] += [len(row) for row in rows]
+                values = np.concatenate(rows)
+            else:
+                values = np.stack(rows)
+                if self.row_shapes.setdefault(k, values.shape[1:]) != values.shape[1:]:
+                    raise ValueError("Column `{}` has rows of shape {}, expected {}".format(
+                                     k, values.shape[1:], self.row_shapes[k]))
+            self.files[k].write(values.astype(self.dtypes[k]).tobytes())
+
+        self.num_of_segments += num_of_segments
+
+    def close(self, seed=None):
+        for f in self.files.values():
+            f.close()
+
+        idx = np.arange(self.num_of_segments)
+        if seed is not None:
+            np.random.seed(seed)
+            np.random.shuffle(idx)
+
+        for k in self.dtypes:
+            tmp_fname = os.path.join(self.path, k + ".bin.tmp")
+            values = np.fromfile(tmp_fname, dtype=self.dtypes[k])
+            if k in self.ragged:
+                offsets = np.zeros(self.num_of_segments + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum(self.lengths[k])
+                column = RaggedArray(values, offsets)[idx]
+                np.save(os.path.join(self.path, k + "_offsets.npy"), column.offsets)
+                np.save(os.path.join(self.path, k + ".npy"), column.values)
+            else:
+                values = values.reshape((self.num_of_segments,) + self.row_shapes.get(k, ()))
+                np.save(os.path.join(self.path, k + ".npy"), values[idx])
+            os.remove(tmp_fname)
+        save_store_hash(self.path)
+
+
+def save_store(path, **columns):
+    '''
+    Save arrays and RaggedArrays as a store directory, one .npy file per column.
+    '''
+    os.makedirs(path, exist_ok=True)
+    for k, column in columns.items():
+        if isinstance(column, RaggedArray):
+            np.save(os.path.join(path, k + "_offsets.npy"), column.offsets - column.offsets[0])
+            np.save(os.path.join(path, k + ".npy"), column.values[column.offsets[0] : column.offsets[-1]])
+        else:
+            np.save(os.path.join(path, k + ".npy"), column)
+    save_store_hash(path)
+
+
+def load_store(path, mmap_mode=None):
+    '''
+    Load a store directory written by SegmentStoreWriter or save_store as a dict of
+    columns. Columns with offsets come back as RaggedArrays. With `mmap_mode` = "r"
+    the columns are memory-mapped read-only and shared by all processes on the host.
+    '''
+    columns = {}
+    for fname in sorted(os.listdir(path)):
+        if not fname.endswith(".npy") or fname.endswith("_offsets.npy"):
+            continue
+        k = fname[:-len(".npy")]
+        values = np.load(os.path.join(path, fname), mmap_mode=mmap_mode)
+        if os.path.exists(os.path.join(path, k + "_offsets.npy")):
+            values = RaggedArray(values, np.load(os.path.join(path, k + "_offsets.npy"), mmap_mode=mmap_mode))
+        columns[k] = values
+    return columns
+
+
+def sanitize_chroma(chroma):
+    '''
+    Keep the three largest values of every chroma row and zero the rest. Returns the
+    sanitized rows that are not all zero, together with their indices.
+    '''
+    chroma = np.array(chroma)
+    if len(chroma) == 0:
+        return chroma, np.zeros((0,), dtype=np.int64)
+    third_largest = -np.partition(-chroma, 2, axis=-1)[:, 2:3]
+    chroma[chroma < third_largest] = 0
+    keep = np.flatnonzero(np.count_nonzero(chroma, axis=-1))
+    return chroma[keep], keep
+
+
+def compute_store_hash(path, chunk_size=1 << 24):
+    '''
+    Content hash of the column files of a store directory.
+    '''
+    h = hashlib.sha1()
+    for k in sorted(os.listdir(path)):
+        if not k.endswith(".npy"):
+            continue
+        h.update(k.encode())
+        with open(os.path.join(path, k), "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def save_store_hash(path):
+    '''
+    Hash the column files of a store once, when it is written, and save the hash next to them.
+    '''
+    store_hash = compute_store_hash(path)
+    with open(os.path.join(path, "store_hash.tmp"), "w") as f:
+        f.write(store_hash)
+    os.replace(os.path.join(path, "store_hash.tmp"), os.path.join(path, "store_hash"))
+    return store_hash
+
+
+def get_store_hash(path):
+    '''
+    Content hash of a store directory, saved with it by SegmentStoreWriter and save_store.
+    Copying or touching a store keeps its hash, so the sanitized cache stays valid. Stores
+    written before the hash was saved are hashed once here.
+    '''
+    if not os.path.exists(os.path.join(path, "store_hash")):
+        return save_store_hash(path)
+    with open(os.path.join(path, "store_hash")) as f:
+        return f.read().strip()
+
+
+def get_split_ranges(num_of_segments):
+    '''
+    80/10/10 train/val/test row ranges of a dataset with `num_of_segments` rows.
+    '''
+    tlen, vlen = int(0.8 * num_of_segments), int(0.9 * num_of_segments)
+    return {"train": [0, tlen], "val": [tlen, vlen], "test": [vlen, num_of_segments]}
+
+
+def load_sanitized_store(path, chroma):
+    '''
+    Sanitized chroma, kept row indices and split manifest of the store at `path`.
+    They are computed once and saved under path/sanitized with a manifest of the
+    80/10/10 train/val/test row ranges the datasets use. Later calls load them
+    directly while the manifest matches the content hash of the store.
+    '''
+    out_dir = os.path.join(path, "sanitized")
+    manifest_fname = os.path.join(out_dir, "manifest.json")
+    store_hash = get_store_hash(path)
+    if os.path.exists(manifest_fname):
+        with open(manifest_fname) as f:
+            manifest = json.load(f)
+        if manifest["store"] == store_hash:
+            return np.load(os.path.join(out_dir, "chroma.npy")), np.load(os.path.join(out_dir, "keep.npy")), manifest
+
+    chroma, keep = sanitize_chroma(chroma)
+    num_of_segments = len(keep)
+    manifest = {"store": store_hash,
+                "num_of_segments": num_of_segments,
+                "splits": get_split_ranges(num_of_segments)}
     
-    return data_lst, rhythm_lst, note_density_lst, chroma_lst
+    # the manifest is written last, so an interrupted save is simply redone
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "chroma.npy"), chroma)
+    np.save(os.path.join(out_dir, "keep.npy"), keep)
+    with open(manifest_fname + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_fname + ".tmp", manifest_fname)
+    return chroma, keep, manifest
 
 
-def get_classic_piano(data_type="short"):
+def get_classic_piano_files():
     '''
-    Main data function for Yamaha Piano e-Competition dataset.
+    MIDI files of the Yamaha Piano e-Competition dataset.
     '''
     labelled_midi = ["/data/haohao_tan/haohao/classic-piano/" + k \
                       for k in os.listdir("/data/haohao_tan/haohao/classic-piano/")]
     labelled_midi += ["/data/haohao_tan/haohao/piano-e-competition/" + k \
                       for k in os.listdir("/data/haohao_tan/haohao/piano-e-competition/")]
+    return labelled_midi
+
+
+def get_classic_piano(data_type="short", num_workers=0, rebuild=False, mmap_mode="r", return_splits=False):
+    '''
+    Main data function for Yamaha Piano e-Competition dataset.
+    Set `num_workers` > 0, the `preprocess_workers` config key, to preprocess files in a
+    process pool. Results are collected in file order, so the saved arrays match the
+    serial path.
+    Per-file features are cached under FEATURE_CACHE_DIR, so `rebuild` = True only
+    processes new or changed files when consolidating the dataset.
+    The store is memory-mapped with `mmap_mode` and the returned tokens, rhythm and
+    note density are row views of it; set `mmap_mode` = None to load it into memory.
+    With `return_splits` = True the train/val/test row ranges of the split manifest are
+    returned as well, to be passed to YamahaDataset.
+    '''
+    labelled_midi = get_classic_piano_files()
 
     print("Dataset length:", len(labelled_midi))
     keylst = labelled_midi
 
-    if not os.path.exists("data/values_v3/data.npy"):
-        data_lst = []
-        rhythm_lst = []
-        note_density_lst = []
-        tempo_change_lst = []
-        velocity_lst = []
-        chroma_lst = []
-        key_signature_lst = []
-
-        for i, name in tqdm(enumerate(keylst), total=len(keylst)):
-            try:
-                # process data
-                if data_type == "short":
-                    beat_res, num_of_beats, max_tokens = 4, 4, 100
-                elif data_type == "long":
-                    beat_res, num_of_beats, max_tokens = 4, 16, 250
-                    
-                cur_data_lst, cur_rhythm_lst, cur_note_lst, cur_chroma_lst = process_data(name,
-                                                                                          beat_res=beat_res, 
-                                                                                          num_of_beats=num_of_beats, 
-                                                                                          max_tokens=max_tokens)
-                data_lst += cur_data_lst
-                rhythm_lst += cur_rhythm_lst
-                note_density_lst += cur_note_lst
-                chroma_lst += cur_chroma_lst
-        
-            except Exception as e:
-                print(e)
-                print("Current dataset: {}".format(len(data_lst)))
+    # convert the dense arrays saved by earlier versions once
+    is_stored = os.path.exists(os.path.join(DATA_STORE_DIR, "tokens.npy"))
+    if not rebuild and not is_stored and os.path.exists("data/values_v3/data.npy"):
+        save_store(DATA_STORE_DIR, 
+                   tokens=RaggedArray.from_padded(np.load("data/values_v3/data.npy")),
+                   **{k: np.load("data/values_v3/{}.npy".format(k)).astype(STORE_DTYPES[k]) \
+                      for k in ["rhythm", "note_density", "chroma"]})
+        is_stored = True
+
+    if rebuild or not is_stored:
+        if data_type not in SEGMENT_PARAMS:
+            raise ValueError("`data_type` must be one of {'short', 'long'}.")
+        beat_res, num_of_beats, max_tokens = SEGMENT_PARAMS[data_type]
+
+        cache_dir = os.path.join(FEATURE_CACHE_DIR, "{}_{}_{}".format(beat_res, num_of_beats, max_tokens))
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_keys = set()
+
+        jobs = [(name, beat_res, num_of_beats, max_tokens, cache_dir) for name in keylst]
+
+        # stream segments to disk as files come in; leaving the block stops the workers,
+        # also when a file or the writer fails
+        writer = SegmentStoreWriter(DATA_STORE_DIR)
+        with (Pool(num_workers) if num_workers > 0 else contextlib.nullcontext()) as pool:
+            results = pool.imap(_process_file, jobs) if pool is not None else map(_process_file, jobs)
+            for res in tqdm(results, total=len(jobs)):
+                if res is None:
+                    print("Current dataset: {}".format(writer.num_of_segments))
+                    continue
+                
+                key, segments = res
+                cur_data_lst, cur_rhythm_lst, cur_note_lst, cur_chroma_lst = unpack_segments(segments)
+                cache_keys.add(key)
+                writer.add(tokens=cur_data_lst, rhythm=cur_rhythm_lst, 
+                           note_density=cur_note_lst, chroma=cur_chroma_lst)
 
-        # consolidate data
-        data_lst = torch.nn.utils.rnn.pad_sequence(data_lst, batch_first=True).numpy().astype(int)
-        rhythm_lst = np.array(rhythm_lst)
-        note_density_lst = np.array(note_density_lst)
-        chroma_lst = np.array(chroma_lst)
+        # drop cache entries of files that were removed or changed
+        for k in os.listdir(cache_dir):
+            if k.endswith(".npz") and k[:-len(".npz")] not in cache_keys:
+                os.remove(os.path.join(cache_dir, k))
 
         # shuffle data
-        np.random.seed(777)
-        idx = np.arange(len(data_lst))
-        np.random.shuffle(idx)
-        data_lst, rhythm_lst, note_density_lst, chroma_lst = data_lst[idx], \
-                                                            rhythm_lst[idx], \
-                                                            note_density_lst[idx], \
-                                                            chroma_lst[idx]
-
-        print("Shapes for: Data, Rhythm Density, Note Density, Chroma")
-        print(data_lst.shape, rhythm_lst.shape, note_density_lst.shape, chroma_lst.shape)
-
-        np.save("data/values_v3/data.npy", data_lst)
-        np.save("data/values_v3/rhythm.npy", rhythm_lst)
-        np.save("data/values_v3/note_density.npy", note_density_lst)
-        np.save("data/values_v3/chroma.npy", chroma_lst)
-
+        writer.close(seed=777)
         print("Dataset saved!")
-    
-    else:
-        data_lst = np.load("data/values_v3/data.npy")
-        rhythm_lst = np.load("data/values_v3/rhythm.npy")
-        note_density_lst = np.load("data/values_v3/note_density.npy")
-        chroma_lst = np.load("data/values_v3/chroma.npy")
-
-        # sanitization
-        idx = []
-
-        for i in tqdm(range(len(chroma_lst))):
-            c = chroma_lst[i]
-            third_largest = -np.sort(-c)[2]
-            c[c < third_largest] = 0
-            chroma_lst[i] = c
-            if np.count_nonzero(chroma_lst[i]) == 0:
-                idx.append(i)
-
-        data_lst = np.delete(data_lst, idx, axis=0)
-        rhythm_lst = np.delete(rhythm_lst, idx, axis=0)
-        note_density_lst = np.delete(note_density_lst, idx, axis=0)
-        chroma_lst = np.delete(chroma_lst, idx, axis=0)
-
-        print("Shapes for: Data, Rhythm Density, Note Density, Chroma")
-        print(data_lst.shape, rhythm_lst.shape, note_density_lst.shape, chroma_lst.shape)
 
+    store = load_store(DATA_STORE_DIR, mmap_mode=mmap_mode)
+    data_lst, rhythm_lst, note_density_lst = store["tokens"], store["rhythm"], store["note_density"]
+
+    # sanitization, keeping the token, rhythm and note rows as views of the store; a freshly
+    # built store goes through it too, so every run sees the same rows and splits
+    chroma_lst, keep, manifest = load_sanitized_store(DATA_STORE_DIR, store["chroma"])
+    data_lst, rhythm_lst, note_density_lst = [RowView(k, keep) for k in [data_lst, rhythm_lst, note_density_lst]]
+    splits = manifest["splits"]
+
+    print("Shapes for: Data, Rhythm Density, Note Density, Chroma")
+    print(data_lst.shape, rhythm_lst.shape, note_density_lst.shape, chroma_lst.shape)
+
+    if return_splits:
+        return data_lst, rhythm_lst, note_density_lst, chroma_lst, splits
     return data_lst, rhythm_lst, note_density_lst, chroma_lst
 
 
-def get_vgmidi():
+def _vgmidi_chroma(songs):
+    '''
+    Process pool worker for build_vgmidi_chroma. Each song is decoded in memory with the
+    worker's performance encoder and keyed from its notes; failed songs get a zero vector.
+    '''
+    res = np.zeros((len(songs), 24))
+    for i, tokens in enumerate(songs):
+        chroma = get_harmony_vector(magenta_decode_midi(tokens), is_one_hot=True)
+        if chroma is not None:
+            res[i] = chroma
+    return res
+
+
+def build_vgmidi_chroma(data_lst, fname, num_workers=0, chunk_size=64):
+    '''
+    One-hot key vectors of all VGMIDI songs, saved to `fname`. Songs are processed in
+    chunks of `chunk_size`, in a process pool when `num_workers` > 0, and every finished
+    chunk is checkpointed next to `fname`, so an interrupted build resumes where it stopped.
+    '''
+    parts_dir = "{}.parts_{}_{}".format(fname, len(data_lst), chunk_size)
+    os.makedirs(parts_dir, exist_ok=True)
+    part_fname = lambda i: os.path.join(parts_dir, "{:05d}.npy".format(i))
+
+    starts = list(range(0, len(data_lst), chunk_size))
+    todo = [i for i in range(len(starts)) if not os.path.exists(part_fname(i))]
+    print("VGMIDI chroma: {} / {} chunks done".format(len(starts) - len(todo), len(starts)))
+
+    # chunks are sliced from the store only when the pool asks for them
+    songs = ([data_lst[j].tolist() for j in range(starts[i], min(starts[i] + chunk_size, len(data_lst)))] \
+             for i in todo)
+    with (Pool(num_workers) if num_workers > 0 else contextlib.nullcontext()) as pool:
+        results = pool.imap(_vgmidi_chroma, songs) if pool is not None else map(_vgmidi_chroma, songs)
+        for i, res in tqdm(zip(todo, results), total=len(todo)):
+            with open(part_fname(i) + ".tmp", "wb") as f:
+                np.save(f, res)
+            os.replace(part_fname(i) + ".tmp", part_fname(i))
+
+    chroma_lst = np.concatenate([np.load(part_fname(i)) for i in range(len(starts))]) if starts else np.zeros((0, 24))
+    np.save(fname, chroma_lst)
+    shutil.rmtree(parts_dir)
+    return chroma_lst
+
+
+def get_vgmidi(num_workers=0):
     '''
     Main data function for VGMIDI dataset.
+    Set `num_workers` > 0, the `preprocess_workers` config key, to build missing key
+    vectors in a process pool.
     '''
-    data_lst = np.load("data/filtered_songs_disambiguate/song_tokens.npy", allow_pickle=True)
-    rhythm_lst = np.load("data/filtered_songs_disambiguate/rhythm_lst.npy", allow_pickle=True)
-    note_density_lst = np.load("data/filtered_songs_disambiguate/note_lst.npy", allow_pickle=True)
+    store_dir = "data/filtered_songs_disambiguate/store"
+    if os.path.exists(os.path.join(store_dir, "tokens.npy")):
+        store = load_store(store_dir, mmap_mode="r")
+        data_lst, rhythm_lst, note_density_lst = store["tokens"], store["rhythm"], store["note_density"]
+    else:
+        columns = {}
+        for k, fname in [("tokens", "song_tokens"), ("rhythm", "rhythm_lst"), ("note_density", "note_lst")]:
+            seqs = np.load("data/filtered_songs_disambiguate/{}.npy".format(fname), allow_pickle=True)
+            columns[k] = RaggedArray.from_sequences(seqs, dtype=STORE_DTYPES[k])
+        save_store(store_dir, **columns)
+        data_lst, rhythm_lst, note_density_lst = columns["tokens"], columns["rhythm"], columns["note_density"]
+
     valence_lst = np.load("data/filtered_songs_disambiguate/valence_lst.npy")
     arousal_lst = np.load("data/filtered_songs_disambiguate/arousal_lst.npy")
 
     if os.path.exists("data/filtered_songs_disambiguate/chroma_lst.npy"):
         chroma_lst = np.load("data/filtered_songs_disambiguate/chroma_lst.npy")
     else:
-        chroma_lst = []
-        for _, token in tqdm(enumerate(data_lst), total=len(data_lst)):
-            pm = magenta_decode_midi(token)
-            pm.write("vgmidi_tmp.mid")
-            chroma = get_harmony_vector("vgmidi_tmp.mid", is_one_hot=True)
-            chroma_lst.append(chroma)
-        chroma_lst = np.array(chroma_lst)
-        np.save("data/filtered_songs_disambiguate/chroma_lst.npy", chroma_lst)
+        chroma_lst = build_vgmidi_chroma(data_lst, "data/filtered_songs_disambiguate/chroma_lst.npy", 
+                                         num_workers=num_workers)
     
     print("Shapes for: Data, Rhythm Density, Note Density, Chroma")
     print(data_lst.shape, rhythm_lst.shape, note_density_lst.shape, chroma_lst.shape)
@@ -400,48 +1199,162 @@ def get_vgmidi():
 class YamahaDataset(Dataset):
     '''
     Yamaha Piano e-competition dataset loader. No arousal/valence labels.
+    `splits` are the row ranges returned by get_classic_piano(return_splits=True).
     '''
-    def __init__(self, data, rhythm, note, chroma, mode="train"):
+    def __init__(self, data, rhythm, note, chroma, mode="train", trim_padding=False, min_width=0, splits=None):
         super().__init__()
         inputs = data, rhythm, note, chroma
-        indexed = []
 
         # train test split
-        tlen, vlen = int(0.8 * len(data)), int(0.9 * len(data))
-
-        for input in inputs:
-            if mode == "train":
-                indexed.append(input[:tlen])
-            elif mode == "val":
-                indexed.append(input[tlen:vlen])
-            elif mode == "test":
-                indexed.append(input[vlen:])
+        if splits is None:
+            splits = get_split_ranges(len(data))
+        if mode not in splits:
+            raise ValueError("`mode` must be one of {'train', 'val', 'test'}.")
+        start, end = splits[mode]
+        indexed = [input[start:end] for input in inputs]
 
         self.data, self.rhythm, self.note, self.chroma = indexed
-        self.r_density = [Counter(k)[1] / len(k) for k in self.rhythm]
-        self.n_density = np.array([sum(k) / len(k) for k in self.note])
+        self.r_density = np.count_nonzero(np.asarray(self.rhythm) == 1, axis=-1) / self.rhythm.shape[-1]
+        self.n_density = np.sum(np.asarray(self.note), axis=-1, dtype=float) / self.note.shape[-1]
+
+        # batches fetched through __getitems__ are cut to their longest token sequence,
+        # but never below min_width
+        self.lengths = get_sequence_lengths(self.data)
+        self.trim_padding, self.min_width = trim_padding, min_width
                 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
+        # copy rows out of the read-only store, padding tokens to the stored width
         x = self.data[idx]
-        r = self.rhythm[idx]
-        n = self.note[idx]
-        c = self.chroma[idx]
+        x = np.pad(x, (0, self.data.shape[1] - len(x)))
+        r = np.array(self.rhythm[idx])
+        n = np.array(self.note[idx])
+        c = np.array(self.chroma[idx])
         
         r_density = self.r_density[idx]
         n_density = self.n_density[idx]
         
         return x, r, n, c, r_density, n_density
 
+    def __getitems__(self, indices):
+        '''
+        Fetch a whole batch with one fancy index per array. Returns the stacked tensors
+        the default collate would build from __getitem__; use with collate_batch.
+        '''
+        idx = np.asarray(indices, dtype=np.int64)
+        x = np.asarray(self.data[idx])
+        if self.trim_padding and len(idx) > 0:
+            x = x[:, :max(int(self.lengths[idx].max()), self.min_width)]
+        r = np.asarray(self.rhythm[idx])
+        n = np.asarray(self.note[idx])
+        c = np.asarray(self.chroma[idx])
+        return [torch.from_numpy(np.array(k)) for k in [x, r, n, c, self.r_density[idx], self.n_density[idx]]]
+
+
+class StreamingYamahaDataset(IterableDataset):
+    '''
+    Yamaha dataset segmented on the fly from the MIDI files, so training can start before
+    get_classic_piano has built the store. Files are split 80/10/10 by `mode`, sharded over
+    DataLoader workers and their items mixed in a shuffle buffer of `shuffle_buffer` items.
+    Files with a feature cache entry are read from it; with `write_through` = True new files
+    are cached as they are processed, so later epochs and get_classic_piano reuse them.
+    Items match YamahaDataset, with tokens padded to the maximum token length. The file
+    order and shuffle buffer are seeded with the epoch given to set_epoch, which
+    make_dataloader calls before every pass.
+    '''
+    def __init__(self, names=None, data_type="short", mode="train", shuffle_buffer=512, seed=777, 
+                 write_through=True):
+        super().__init__()
+        if data_type not in SEGMENT_PARAMS:
+            raise ValueError("`data_type` must be one of {'short', 'long'}.")
+        self.beat_res, self.num_of_beats, self.max_tokens = SEGMENT_PARAMS[data_type]
+        self.cache_dir = os.path.join(FEATURE_CACHE_DIR, "{}_{}_{}".format(*SEGMENT_PARAMS[data_type]))
+
+        # file level train test split
+        names = sorted(get_classic_piano_files() if names is None else names)
+        names = [names[i] for i in np.random.RandomState(seed).permutation(len(names))]
+        tlen, vlen = int(0.8 * len(names)), int(0.9 * len(names))
+        if mode == "train":
+            self.names = names[:tlen]
+        elif mode == "val":
+            self.names = names[tlen:vlen]
+        elif mode == "test":
+            self.names = names[vlen:]
+        
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.write_through = write_through
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_segments(self, name):
+        params = self.beat_res, self.num_of_beats, self.max_tokens
+        try:
+            cache_fname = os.path.join(self.cache_dir, get_feature_cache_key(name, *params) + ".npz")
+            if os.path.exists(cache_fname):
+                return unpack_segments(load_feature_cache(cache_fname))
+            
+            res = process_data(name, *params)
+            if self.write_through:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                save_feature_cache(cache_fname, pack_segments(*res, seg_len=self.beat_res * self.num_of_beats))
+            return res
+        
+        except Exception as e:
+            print(e)
+            return [], [], [], []
+
+    def get_items(self, name):
+        for events, rhythm, note, chroma in zip(*self.get_segments(name)):
+            # same chroma sanitization as get_classic_piano
+            c = np.array(chroma, dtype=STORE_DTYPES["chroma"])
+            c[c < -np.sort(-c)[2]] = 0
+            if np.count_nonzero(c) == 0:
+                continue
+            
+            x = np.zeros(self.max_tokens, dtype=STORE_DTYPES["tokens"])
+            x[:len(events)] = np.asarray(events)
+            r = np.asarray(rhythm, dtype=STORE_DTYPES["rhythm"])
+            n = np.asarray(note, dtype=STORE_DTYPES["note_density"])
+            r_density = np.count_nonzero(r == 1) / len(r)
+            n_density = np.sum(n, dtype=float) / len(n)
+            yield x, r, n, c, r_density, n_density
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker_id, num_of_workers = (0, 1) if info is None else (info.id, info.num_workers)
+
+        # every worker draws the same file order and takes its own share of it
+        order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.names))
+        names = [self.names[i] for i in order[worker_id::num_of_workers]]
+        rng = np.random.RandomState([self.seed, self.epoch, worker_id])
+
+        buffer = []
+        for name in names:
+            for item in self.get_items(name):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(item)
+                    continue
+                i = rng.randint(len(buffer))
+                yield buffer[i]
+                buffer[i] = item
+        
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
 
 class VGMIDIDataset(Dataset):
     '''
     VGMIDI dataset loader.
     '''
-    def __init__(self, data, rhythm, note, chroma, arousal, valence, mode="train"):
+    def __init__(self, data, rhythm, note, chroma, arousal, valence, mode="train", trim_padding=False, min_width=0):
         super().__init__()
+        data, rhythm, note = [k if isinstance(k, RaggedArray) else RaggedArray.from_sequences(k, dtype=None) \
+                              for k in [data, rhythm, note]]
         inputs = data, rhythm, note, chroma, arousal, valence
         indexed = []
 
@@ -456,18 +1369,15 @@ class VGMIDIDataset(Dataset):
                 indexed.append(input[vlen:])
 
         self.data, self.rhythm, self.note, self.chroma, self.arousal, self.valence = indexed
-        self.data = [torch.Tensor(np.insert(k, -1, 1)) for k in self.data]
-        self.data = torch.nn.utils.rnn.pad_sequence(self.data, batch_first=True)
 
-        # put this before applying torch.Tensor
-        self.r_density = [Counter(list(k))[1] / len(k) for k in self.rhythm]
-        self.n_density = np.array([sum(k) / len(k) for k in self.note])
+        # sequences are padded to the longest one of the split, tokens get an extra EOS
+        self.widths = [int(k.lengths.max()) if len(k) > 0 else 0 for k in [self.data, self.rhythm, self.note]]
+        self.widths[0] += 1
+        self.lengths = self.data.lengths + 1
+        self.trim_padding, self.min_width = trim_padding, min_width
 
-        self.rhythm = [torch.Tensor(k) for k in self.rhythm]
-        self.note = [torch.Tensor(k) for k in self.note]
-        
-        self.rhythm = torch.nn.utils.rnn.pad_sequence(self.rhythm, batch_first=True)
-        self.note = torch.nn.utils.rnn.pad_sequence(self.note, batch_first=True)
+        self.r_density = np.array([np.count_nonzero(k == 1) / len(k) for k in self.rhythm])
+        self.n_density = np.array([np.sum(k, dtype=float) / len(k) for k in self.note])
 
         self.arousal[self.arousal >= 0] = 1
         self.arousal[self.arousal < 0] = 0
@@ -476,9 +1386,9 @@ class VGMIDIDataset(Dataset):
         return len(self.data)
 
     def __getitem__(self, idx):
-        x = self.data[idx]
-        r = self.rhythm[idx]
-        n = self.note[idx]
+        x, r, n = [np.insert(self.data[idx], -1, 1), self.rhythm[idx], self.note[idx]]
+        x, r, n = [torch.from_numpy(np.pad(k.astype(np.float32), (0, width - len(k)))) \
+                   for k, width in zip([x, r, n], self.widths)]
         c = self.chroma[idx]
         a = self.arousal[idx]
         v  =self.valence[idx]
@@ -487,3 +1397,230 @@ class VGMIDIDataset(Dataset):
         n_density = self.n_density[idx]
         
         return x, r, n, c, a, v, r_density, n_density
+
+    def __getitems__(self, indices):
+        '''
+        Fetch a whole batch with one gather per array. Returns the stacked tensors the
+        default collate would build from __getitem__; use with collate_batch.
+        '''
+        idx = np.asarray(indices, dtype=np.int64)
+        data, rhythm, note = self.data[idx], self.rhythm[idx], self.note[idx]
+        lengths = data.lengths
+        widths = self.widths
+        if self.trim_padding and len(idx) > 0:
+            # pad every sequence to the longest one of the batch instead of the split
+            widths = [min(max(int(k.lengths.max()) + extra, self.min_width), width) for k, extra, width in 
+                      zip([data, rhythm, note], [1, 0, 0], self.widths)]
+        x, r, n = [k.to_padded(width, dtype=np.float32) for k, width in 
+                   zip([data, rhythm, note], widths)]
+        
+        # insert the extra EOS before the last token
+        rows = np.arange(len(idx))
+        x[rows, lengths] = x[rows, lengths - 1]
+        x[rows, lengths - 1] = 1
+        
+        batch = [x, r, n, self.chroma[idx], self.arousal[idx], self.valence[idx], 
+                 self.r_density[idx], self.n_density[idx]]
+        return [torch.from_numpy(np.array(k)) for k in batch]
+
+
+def get_sequence_lengths(seqs, pad_value=0):
+    '''
+    Unpadded length of every row of a RaggedArray, a RowView or a dense padded array.
+    '''
+    if isinstance(seqs, RaggedArray):
+        return seqs.lengths
+    if isinstance(seqs, RowView):
+        return get_sequence_lengths(seqs.base, pad_value)[seqs.idx]
+    is_value = np.asarray(seqs) != pad_value
+    return np.where(is_value.any(axis=1), is_value.shape[1] - np.argmax(is_value[:, ::-1], axis=1), 0)
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    Batch sampler that groups sequences of similar length. Indices are sorted by length
+    and split into `num_buckets` buckets of equal size; every epoch the buckets are
+    shuffled, cut into batches, and the batches shuffled again. Pair it with a dataset
+    built with trim_padding=True so each batch is only padded to its own longest sequence.
+    '''
+    def __init__(self, lengths, batch_size, num_buckets=10, shuffle=True, drop_last=False, seed=None):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rng = np.random.RandomState(seed)
+        order = np.argsort(self.lengths, kind="stable")
+        self.buckets = [k for k in np.array_split(order, max(1, min(num_buckets, len(order)))) if len(k) > 0]
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = self.rng.permutation(bucket)
+            batches += [bucket[i : i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        if self.drop_last:
+            batches = [k for k in batches if len(k) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(k) // self.batch_size for k in self.buckets)
+        return sum(math.ceil(len(k) / self.batch_size) for k in self.buckets)
+
+
+def padding_report(lengths, batch_size, num_buckets=10, width=None, seed=0):
+    '''
+    Share of padded token positions when every batch is padded to `width` (default: the
+    longest sequence), compared with shuffled and length-bucketed batches that are each
+    trimmed to their own longest sequence.
+    '''
+    lengths = np.asarray(lengths)
+    width = int(lengths.max()) if width is None else width
+    total = len(lengths) * width
+
+    def trimmed_ratio(sampler):
+        padded = sum(len(k) * int(lengths[k].max()) for k in sampler)
+        return 1 - lengths.sum() / padded
+
+    report = {"full_width": 1 - lengths.sum() / total,
+              "trimmed": trimmed_ratio(BucketBatchSampler(lengths, batch_size, 1, seed=seed)),
+              "bucketed": trimmed_ratio(BucketBatchSampler(lengths, batch_size, num_buckets, seed=seed))}
+    print("Padding ratio: full width {:.3f}, per-batch trim {:.3f}, {} buckets + trim {:.3f}".format(
+          report["full_width"], report["trimmed"], num_buckets, report["bucketed"]))
+    return report
+
+
+def collate_batch(batch):
+    '''
+    collate_fn for datasets with __getitems__, whose batches come out already stacked.
+    Lists of single items, e.g. from torch versions without __getitems__ support,
+    go through the default collate.
+    '''
+    if all(torch.is_tensor(k) for k in batch):
+        return batch
+    return default_collate(batch)
+
+
+def collate_inputs(batch):
+    '''
+    collate_batch followed by the type conversion of the model inputs: tokens, rhythm and
+    note density as long, chroma as float. Running it as the collate_fn moves the conversion
+    into the DataLoader workers.
+    '''
+    batch = list(collate_batch(batch))
+    batch[:3] = [k.long() for k in batch[:3]]
+    batch[3] = batch[3].float()
+    return batch
+
+
+class DevicePrefetcher:
+    '''
+    Iterate a DataLoader in a background thread that moves the first `num_of_inputs` entries
+    of every batch to `device`, so the next batch is loaded and copied while the current
+    one is in use. The remaining entries, e.g. attribute labels, stay on the host.
+    '''
+    def __init__(self, loader, device="cuda", num_of_inputs=4, queue_size=2):
+        self.loader = loader
+        self.device = device
+        self.num_of_inputs = num_of_inputs
+        self.queue_size = queue_size
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def prefetch():
+            try:
+                for batch in self.loader:
+                    batch = list(batch)
+                    batch[:self.num_of_inputs] = [k.to(self.device, non_blocking=True) \
+                                                  for k in batch[:self.num_of_inputs]]
+                    if not put(batch):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=prefetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+class EpochLoader:
+    '''
+    Iterate a DataLoader over an IterableDataset with a set_epoch method, calling
+    set_epoch with the number of the pass before each one. As the number of batches is
+    only known once a pass is done, len() gives the count of the last finished pass,
+    or of the current pass once it has finished.
+    '''
+    def __init__(self, loader):
+        self.loader = loader
+        self.epoch = 0
+        self.num_of_batches = 0
+
+    def __len__(self):
+        return self.num_of_batches
+
+    def __iter__(self):
+        self.loader.dataset.set_epoch(self.epoch)
+        self.epoch += 1
+        num_of_batches = 0
+        for batch in self.loader:
+            num_of_batches += 1
+            yield batch
+        self.num_of_batches = num_of_batches
+
+
+def make_dataloader(dataset, args, batch_size=1, shuffle=False, batch_sampler=None):
+    '''
+    DataLoader configured by the model config: `num_workers`, `persistent_workers`,
+    `prefetch_factor` and `pin_memory`, with collate_inputs converting batches in the
+    workers. With `prefetch_to_device` and a GPU available, batches are moved to the
+    GPU by a DevicePrefetcher.
+    An IterableDataset shuffles itself, so `shuffle` is not passed for it, and it goes
+    through an EpochLoader. Its workers are restarted every pass, so they get the dataset
+    after set_epoch, whatever `persistent_workers` says.
+    '''
+    num_workers = args.get("num_workers", 0)
+    use_cuda = torch.cuda.is_available()
+    is_iterable = isinstance(dataset, IterableDataset)
+    kwargs = {"batch_sampler": batch_sampler} if batch_sampler is not None else \
+             {"batch_size": batch_size} if is_iterable else \
+             {"batch_size": batch_size, "shuffle": shuffle}
+    if num_workers > 0:
+        kwargs["persistent_workers"] = args.get("persistent_workers", False) and not is_iterable
+        kwargs["prefetch_factor"] = args.get("prefetch_factor", 2)
+
+    loader = DataLoader(dataset, num_workers=num_workers, collate_fn=collate_inputs,
+                        pin_memory=args.get("pin_memory", False) and use_cuda, **kwargs)
+    if is_iterable:
+        loader = EpochLoader(loader)
+    if args.get("prefetch_to_device", False) and use_cuda:
+        return DevicePrefetcher(loader)
+    return loader
@@ -42,6 +42,9 @@ def convert_to_one_hot(input, dims):
 
 
 def clean_output(out):
+    if isinstance(out, np.ndarray):
+        # token ids from model.generate, which already stop before EOS
+        return np.trim_zeros(out)
     recon = np.trim_zeros(torch.argmax(out, dim=-1).cpu().detach().numpy().squeeze())
     if 1 in recon:
         last_idx = np.argwhere(recon == 1)[0][0]
@@ -115,7 +118,7 @@ class BaseEvaluator:
                 r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
                 n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
 
-                res = self.model_forward(model, d_oh, r_oh, n_oh, c)
+                res = self.model_forward(model, d_oh, r_oh, n_oh, c, lengths=(d != 0).sum(dim=-1, keepdim=True))
 
                 z_r, z_n = self.handle_z_output(res)
                 z_r_lst.append(z_r.cpu().detach())
@@ -133,7 +136,8 @@ class BaseEvaluator:
                         track = pypianoroll.parse('tmp.mid', beat_resolution=4).tracks
                         if len(track) < 1: continue
                         pr = track[0].pianoroll
-                        _, rhythm, note, chroma, _ = get_music_attributes(pr, beat=4)
+                        attributes = get_batch_music_attributes(pr[np.newaxis], ("rhythm", "note_density"))
+                        rhythm, note = attributes["rhythm"][0], attributes["note_density"][0]
                         r_density_shifted, n_density_shifted, _, _ = get_classes(rhythm, note)
                         r_density_lst_new.append(r_density_shifted)
                         n_density_lst_new.append(n_density_shifted)
@@ -193,7 +197,7 @@ class BaseEvaluator:
         print("Monotonicity: {} +/- {}".format(np.mean(m_lst), np.std(m_lst)))
         print("============================================")
 
-    def model_forward(self, model, d_oh, r_oh, n_oh, c):
+    def model_forward(self, model, d_oh, r_oh, n_oh, c, lengths=None):
         raise NotImplementedError
 
     def shift(self, model, d, r, n, c, target_z_value):
@@ -227,15 +231,15 @@ class RhythmEvaluator(BaseEvaluator):
     def __init__(self, ds, epochs=10, num_of_samples=100):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
-    def model_forward(self, model, d_oh, r_oh, n_oh, c):
-        return model(d_oh, r_oh, n_oh, c.unsqueeze(0))
+    def model_forward(self, model, d_oh, r_oh, n_oh, c, lengths=None):
+        return model(d_oh, r_oh, n_oh, c.unsqueeze(0), lengths=lengths)
     
     def shift(self, model, d, r, n, c, target_z_value):
         d_oh = convert_to_one_hot(d, EVENT_DIMS).unsqueeze(0)
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
         n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
         
-        res = self.model_forward(model, d_oh, r_oh, n_oh, c)        
+        res = self.model_forward(model, d_oh, r_oh, n_oh, c, lengths=(d != 0).sum(dim=-1, keepdim=True))        
         z_r, z_n = self.handle_z_output(res)
 
         # get original latent variables
@@ -250,7 +254,7 @@ class RhythmEvaluator(BaseEvaluator):
         model.eval()
         z = torch.cat([z_r, z_n, c.unsqueeze(0)], dim=1)  
         
-        out = model.global_decoder(z, steps=100)
+        out = model.generate(z, max_steps=100)[0]
         return out, z_r_0
     
     def is_density_lst_length(self, r_density_lst_new, n_density_lst_new, value_lst):
@@ -276,15 +280,15 @@ class NoteEvaluator(BaseEvaluator):
     def __init__(self, ds, epochs=10, num_of_samples=100):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
-    def model_forward(self, model, d_oh, r_oh, n_oh, c):
-        return model(d_oh, r_oh, n_oh, c.unsqueeze(0))
+    def model_forward(self, model, d_oh, r_oh, n_oh, c, lengths=None):
+        return model(d_oh, r_oh, n_oh, c.unsqueeze(0), lengths=lengths)
     
     def shift(self, model, d, r, n, c, target_z_value):
         d_oh = convert_to_one_hot(d, EVENT_DIMS).unsqueeze(0)
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
         n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
         
-        res = self.model_forward(model, d_oh, r_oh, n_oh, c)
+        res = self.model_forward(model, d_oh, r_oh, n_oh, c, lengths=(d != 0).sum(dim=-1, keepdim=True))
         z_r, z_n = self.handle_z_output(res)
 
         # get original latent variables
@@ -299,7 +303,7 @@ class NoteEvaluator(BaseEvaluator):
         model.eval()
         z = torch.cat([z_r, z_n, c.unsqueeze(0)], dim=1)  
         
-        out = model.global_decoder(z, steps=100)
+        out = model.generate(z, max_steps=100)[0]
         return out, z_n_0
     
     def is_density_lst_length(self, r_density_lst_new, n_density_lst_new, value_lst):
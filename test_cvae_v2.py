@@ -65,7 +65,7 @@ class CVAEEvaluator(BaseEvaluator):
                 r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
                 n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
 
-                dis = self.model_forward(model, d_oh, r_density, n_density, c)
+                dis = self.model_forward(model, d_oh, r_density, n_density, c, lengths=(d != 0).sum(dim=-1, keepdim=True))
                 z = repar(dis.mean, dis.stddev)
 
                 try:
@@ -75,7 +75,7 @@ class CVAEEvaluator(BaseEvaluator):
                         
                         z_cur = torch.cat([z, new_r_density, new_n_density], dim=-1)  
                         model.eval()  
-                        d_shifted = model.global_decoder(z_cur, steps=100)
+                        d_shifted = model.generate(z_cur, max_steps=100)[0]
                         
                         pm = magenta_decode_midi(clean_output(d_shifted))
                         pm.write('tmp.mid')
@@ -84,7 +84,8 @@ class CVAEEvaluator(BaseEvaluator):
                         track = pypianoroll.parse('tmp.mid', beat_resolution=4).tracks
                         if len(track) < 1: continue
                         pr = track[0].pianoroll
-                        _, rhythm, note, chroma, _ = get_music_attributes(pr, beat=4)
+                        attributes = get_batch_music_attributes(pr[np.newaxis], ("rhythm", "note_density"))
+                        rhythm, note = attributes["rhythm"][0], attributes["note_density"][0]
                         r_density_shifted, n_density_shifted, _, _ = get_classes(rhythm, note)
                         r_density_lst_new.append(r_density_shifted)
                         n_density_lst_new.append(n_density_shifted)
@@ -150,8 +151,9 @@ class CVAEEvaluator(BaseEvaluator):
         new_n_density = torch.Tensor([n_density]).cuda().unsqueeze(-1)
         return new_r_density, new_n_density
 
-    def model_forward(self, model, d_oh, r_density, n_density, c):
-        dis = model.encoder(d_oh, torch.Tensor([r_density]).cuda().unsqueeze(0), torch.Tensor([n_density]).cuda().unsqueeze(0), c)
+    def model_forward(self, model, d_oh, r_density, n_density, c, lengths=None):
+        dis = model.encoder(d_oh, torch.Tensor([r_density]).cuda().unsqueeze(0), torch.Tensor([n_density]).cuda().unsqueeze(0), c, 
+                            lengths=lengths)
         return dis
 
     def is_density_lst_length(self, r_density_lst_new, n_density_lst_new, value_lst):
@@ -230,8 +232,8 @@ class RhythmFaderNetsEvaluator(RhythmCVAEEvaluator):
     def __init__(self, ds, epochs=10, num_of_samples=100):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
-    def model_forward(self, model, d_oh, r_density, n_density, c):
-        dis = model.encoder(d_oh)
+    def model_forward(self, model, d_oh, r_density, n_density, c, lengths=None):
+        dis = model.encoder(d_oh, lengths=lengths)
         return dis
 
 
@@ -239,8 +241,8 @@ class NoteFaderNetsEvaluator(NoteCVAEEvaluator):
     def __init__(self, ds, epochs=10, num_of_samples=100):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
-    def model_forward(self, model, d_oh, r_density, n_density, c):
-        dis = model.encoder(d_oh)
+    def model_forward(self, model, d_oh, r_density, n_density, c, lengths=None):
+        dis = model.encoder(d_oh, lengths=lengths)
         return dis
 
 
@@ -296,17 +298,17 @@ if __name__ == "__main__":
     # model.train()
 
     # dataloaders
-    data_lst, rhythm_lst, note_density_lst, chroma_lst = get_classic_piano()
-    tlen, vlen = int(0.8 * len(data_lst)), int(0.9 * len(data_lst))
+    data_lst, rhythm_lst, note_density_lst, chroma_lst, splits = get_classic_piano(num_workers=args['preprocess_workers'],
+                                                                                   return_splits=True)
     train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="train")
-    train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="train", splits=splits)
+    train_dl_dist = make_dataloader(train_ds_dist, args, batch_size=batch_size, shuffle=False)
     val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="val")
-    val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="val", splits=splits)
+    val_dl_dist = make_dataloader(val_ds_dist, args, batch_size=batch_size, shuffle=False)
     test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="test")
-    test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="test", splits=splits)
+    test_dl_dist = make_dataloader(test_ds_dist, args, batch_size=batch_size, shuffle=False)
     dl = test_dl_dist
     print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
 
@@ -72,7 +72,7 @@ def run_through_gmm(dl):
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
         n_oh = convert_to_one_hot(n, NOTE_DIMS)
 
-        res = model(d_oh, r_oh, n_oh, c)
+        res = model(d_oh, r_oh, n_oh, c, lengths=(d != 0).sum(dim=-1))
 
         # package output
         output, dis, z_out, logLogit_out, qy_x_out, y_out = res
@@ -178,17 +178,17 @@ if __name__ == "__main__":
     # model.train()
 
     # dataloaders
-    data_lst, rhythm_lst, note_density_lst, chroma_lst = get_classic_piano()
-    tlen, vlen = int(0.8 * len(data_lst)), int(0.9 * len(data_lst))
+    data_lst, rhythm_lst, note_density_lst, chroma_lst, splits = get_classic_piano(num_workers=args['preprocess_workers'],
+                                                                                   return_splits=True)
     train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="train")
-    train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="train", splits=splits)
+    train_dl_dist = make_dataloader(train_ds_dist, args, batch_size=batch_size, shuffle=False)
     val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="val")
-    val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="val", splits=splits)
+    val_dl_dist = make_dataloader(val_ds_dist, args, batch_size=batch_size, shuffle=False)
     test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="test")
-    test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="test", splits=splits)
+    test_dl_dist = make_dataloader(test_ds_dist, args, batch_size=batch_size, shuffle=False)
     dl = test_dl_dist
     print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
 
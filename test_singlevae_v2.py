@@ -67,7 +67,7 @@ class SingleEvaluator(BaseEvaluator):
                 r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
                 n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
 
-                res = self.model_forward(model, d_oh, r_oh, n_oh, c)
+                res = self.model_forward(model, d_oh, r_oh, n_oh, c, lengths=(d != 0).sum(dim=-1, keepdim=True))
                 out, dis, _ = res
 
                 # get original latent variables
@@ -87,7 +87,8 @@ class SingleEvaluator(BaseEvaluator):
                         track = pypianoroll.parse('tmp.mid', beat_resolution=4).tracks
                         if len(track) < 1: continue
                         pr = track[0].pianoroll
-                        _, rhythm, note, chroma, _ = get_music_attributes(pr, beat=4)
+                        attributes = get_batch_music_attributes(pr[np.newaxis], ("rhythm", "note_density"))
+                        rhythm, note = attributes["rhythm"][0], attributes["note_density"][0]
                         r_density_shifted, n_density_shifted, _, _ = get_classes(rhythm, note)
                         r_density_lst_new.append(r_density_shifted)
                         n_density_lst_new.append(n_density_shifted)
@@ -149,8 +150,8 @@ class SingleEvaluator(BaseEvaluator):
         print("Monotonicity: {} +/- {}".format(np.mean(m_lst), np.std(m_lst)))
         print("============================================")  
 
-    def model_forward(self, model, d_oh, r_oh, n_oh, c):
-        res = model(d_oh, c.unsqueeze(0))
+    def model_forward(self, model, d_oh, r_oh, n_oh, c, lengths=None):
+        res = model(d_oh, c.unsqueeze(0), lengths=lengths)
         return res
 
     def shift(self, model, d, r, n, c, target_z_value):
@@ -184,7 +185,7 @@ class SingleRhythmEvaluator(SingleEvaluator):
         n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
         c = c.unsqueeze(0)
         
-        res = model(d_oh, c)
+        res = model(d_oh, c, lengths=(d != 0).sum(dim=-1, keepdim=True))
         out, dis, _ = res
 
         # get original latent variables
@@ -196,7 +197,7 @@ class SingleRhythmEvaluator(SingleEvaluator):
         model.eval()
         z = torch.cat([z, c], dim=1)  
         
-        out = model.global_decoder(z, steps=100)
+        out = model.generate(z, max_steps=100)[0]
         return out, z_0
     
     def is_density_lst_length(self, r_density_lst_new, n_density_lst_new, value_lst):
@@ -230,7 +231,7 @@ class SingleNoteEvaluator(SingleEvaluator):
         n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
         c = c.unsqueeze(0)
         
-        res = model(d_oh, c)
+        res = model(d_oh, c, lengths=(d != 0).sum(dim=-1, keepdim=True))
         out, dis, _ = res
 
         # get original latent variables
@@ -242,7 +243,7 @@ class SingleNoteEvaluator(SingleEvaluator):
         model.eval()
         z = torch.cat([z, c], dim=1)  
         
-        out = model.global_decoder(z, steps=100)
+        out = model.generate(z, max_steps=100)[0]
         return out, z_0
     
     def is_density_lst_length(self, r_density_lst_new, n_density_lst_new, value_lst):
@@ -287,7 +288,7 @@ def run_through(dl):
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
         n_oh = convert_to_one_hot(n, NOTE_DIMS)
 
-        res = model(d_oh, c)
+        res = model(d_oh, c, lengths=(d != 0).sum(dim=-1))
 
         # package output
         out, dis, z = res
@@ -382,17 +383,17 @@ if __name__ == "__main__":
     # model.train()
 
     # dataloaders
-    data_lst, rhythm_lst, note_density_lst, chroma_lst = get_classic_piano()
-    tlen, vlen = int(0.8 * len(data_lst)), int(0.9 * len(data_lst))
+    data_lst, rhythm_lst, note_density_lst, chroma_lst, splits = get_classic_piano(num_workers=args['preprocess_workers'],
+                                                                                   return_splits=True)
     train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="train")
-    train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="train", splits=splits)
+    train_dl_dist = make_dataloader(train_ds_dist, args, batch_size=batch_size, shuffle=False)
     val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="val")
-    val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="val", splits=splits)
+    val_dl_dist = make_dataloader(val_ds_dist, args, batch_size=batch_size, shuffle=False)
     test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="test")
-    test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="test", splits=splits)
+    test_dl_dist = make_dataloader(test_ds_dist, args, batch_size=batch_size, shuffle=False)
     dl = test_dl_dist
     print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
 
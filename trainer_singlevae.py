@@ -59,20 +59,36 @@ model.train()
 
 # dataloaders
 is_shuffle = True
-data_lst, rhythm_lst, note_density_lst, chroma_lst = get_classic_piano()
-tlen, vlen = int(0.8 * len(data_lst)), int(0.9 * len(data_lst))
-train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, mode="train")
-train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=is_shuffle, num_workers=0)
-val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, mode="val")
-val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=is_shuffle, num_workers=0)
-test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, mode="test")
-test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=is_shuffle, num_workers=0)
-dl = train_dl_dist
-print("Train / Validation / Test")
-print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
+if args['streaming']:
+    # segment the MIDI files on the fly instead of building the dataset store first
+    train_ds_dist = StreamingYamahaDataset(mode="train")
+    train_dl_dist = make_dataloader(train_ds_dist, args, batch_size=batch_size)
+    val_ds_dist = StreamingYamahaDataset(mode="val")
+    val_dl_dist = make_dataloader(val_ds_dist, args, batch_size=batch_size)
+    test_ds_dist = StreamingYamahaDataset(mode="test")
+    test_dl_dist = make_dataloader(test_ds_dist, args, batch_size=batch_size)
+    dl = train_dl_dist
+    print("Train / Validation / Test files")
+    print(len(train_ds_dist.names), len(val_ds_dist.names), len(test_ds_dist.names))
+else:
+    data_lst, rhythm_lst, note_density_lst, chroma_lst, splits = get_classic_piano(num_workers=args['preprocess_workers'],
+                                                                                   return_splits=True)
+    train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
+                                    chroma_lst, mode="train", splits=splits, trim_padding=True)
+    train_sampler = BucketBatchSampler(train_ds_dist.lengths, batch_size, num_buckets=args['num_buckets'], shuffle=is_shuffle)
+    train_dl_dist = make_dataloader(train_ds_dist, args, batch_sampler=train_sampler)
+    val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
+                                    chroma_lst, mode="val", splits=splits, trim_padding=True)
+    val_sampler = BucketBatchSampler(val_ds_dist.lengths, batch_size, num_buckets=args['num_buckets'], shuffle=is_shuffle)
+    val_dl_dist = make_dataloader(val_ds_dist, args, batch_sampler=val_sampler)
+    test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
+                                    chroma_lst, mode="test", splits=splits)
+    test_dl_dist = make_dataloader(test_ds_dist, args, batch_size=batch_size, shuffle=is_shuffle)
+    dl = train_dl_dist
+    print("Train / Validation / Test")
+    print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
+    padding_report(train_ds_dist.lengths, batch_size, num_buckets=args['num_buckets'], 
+                   width=train_ds_dist.data.shape[1])
 
 
 def std_normal(shape):
@@ -127,7 +143,7 @@ def train(step, d_oh, r_oh, n_oh,
           d, r, n, c, r_density, n_density):
     
     optimizer.zero_grad()
-    res = model(d_oh, c)
+    res = model(d_oh, c, lengths=(d != 0).sum(dim=-1))
 
     # package output
     out, dis, z = res
@@ -153,7 +169,7 @@ def train(step, d_oh, r_oh, n_oh,
 def evaluate(step, d_oh, r_oh, n_oh,
              d, r, n, c, r_density, n_density):
     
-    res = model(d_oh, c)
+    res = model(d_oh, c, lengths=(d != 0).sum(dim=-1))
 
     # package output
     out, dis, z = res
@@ -197,7 +213,7 @@ def training_phase(step):
             d, r, n, c = d.cuda().long(), r.cuda().long(), \
                          n.cuda().long(), c.cuda().float()
 
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
+            d_oh = d if args['index_input'] else convert_to_one_hot(d, EVENT_DIMS)
             r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
             n_oh = convert_to_one_hot(n, NOTE_DIMS)
 
@@ -216,7 +232,7 @@ def training_phase(step):
             d, r, n, c = d.cuda().long(), r.cuda().long(), \
                          n.cuda().long(), c.cuda().float()
 
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
+            d_oh = d if args['index_input'] else convert_to_one_hot(d, EVENT_DIMS)
             r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
             n_oh = convert_to_one_hot(n, NOTE_DIMS)
             
@@ -275,11 +291,11 @@ def evaluation_phase():
             d, r, n, c = d.cuda().long(), r.cuda().long(), \
                          n.cuda().long(), c.cuda().float()
 
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
+            d_oh = d if args['index_input'] else convert_to_one_hot(d, EVENT_DIMS)
             r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
             n_oh = convert_to_one_hot(n, NOTE_DIMS)
 
-            res = model(d_oh, c)
+            res = model(d_oh, c, lengths=(d != 0).sum(dim=-1))
 
             # package output
             out, dis, z = res
@@ -342,9 +358,9 @@ def evaluation_phase():
                                                 t_acc_r / data_len, 
                                                 t_acc_n / data_len))
 
-    dl = DataLoader(train_ds_dist, batch_size=128, shuffle=False, num_workers=0)
+    dl = make_dataloader(train_ds_dist, args, batch_size=128, shuffle=False)
     run(dl)
-    dl = DataLoader(test_ds_dist, batch_size=128, shuffle=False, num_workers=0)
+    dl = make_dataloader(test_ds_dist, args, batch_size=128, shuffle=False)
     run(dl)
 
 